@@ -1,16 +1,967 @@
 from typing import Protocol
 import netaddr
 import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import random
+import re
+import sys
+import time
+import uuid
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dcim.choices import InterfaceTypeChoices, InterfaceModeChoices
 from dcim.models import Platform, DeviceRole, Site, Interface
 from ipam.models import IPAddress, VRF, Prefix, VLAN, Service
 from tenancy.models import Tenant
 from virtualization.models import VirtualMachine, Cluster, VMInterface
 from virtualization.choices import VirtualMachineStatusChoices
-from extras.scripts import Script, TextVar, ChoiceVar, ObjectVar
-from extras.models import Tag
+from extras.scripts import Script, TextVar, ChoiceVar, ObjectVar, FileVar, IntegerVar, BooleanVar, MultiObjectVar, run_script
+from extras.choices import JobResultStatusChoices, ObjectChangeActionChoices
+from extras.models import ConfigContext, JobResult, ObjectChange, Tag, Webhook
+from utilities.api import get_serializer_for_model
 from utilities.forms import APISelect
+from utilities.utils import copy_safe_request, deepmerge
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import IntegerField, Max, OuterRef, Q, Subquery, Sum, prefetch_related_objects
+from django.db.models.functions import Cast, Substr
+from django.utils import timezone
+from django.utils.text import slugify
+from django_rq import get_queue
+
+
+class RunStats:
+    """
+    Time and database queries spent per phase of a run
+
+    Totals are counted for every sample, percentiles come from a bounded reservoir per phase
+    so a run of any size keeps at most RESERVOIR timings per phase in memory.
+    """
+
+    RESERVOIR = 1000
+
+    def __init__(self):
+        # phase: [samples, total queries]
+        self.totals = defaultdict(lambda: [0, 0])
+        self.reservoirs = defaultdict(list)
+        self.random = random.Random(0)
+
+    def add(self, phase, milliseconds, queries):
+        """
+        Count a sample, it replaces a random reservoir entry once the reservoir is full
+        """
+        totals = self.totals[phase]
+        totals[0] += 1
+        totals[1] += queries
+        reservoir = self.reservoirs[phase]
+        if len(reservoir) < self.RESERVOIR:
+            reservoir.append(milliseconds)
+        else:
+            index = self.random.randrange(totals[0])
+            if index < self.RESERVOIR:
+                reservoir[index] = milliseconds
+
+    @contextmanager
+    def measure(self, phase, timings=()):
+        """
+        Measure a phase, the figures are spread evenly over the rows in `timings`
+        """
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                yield
+        finally:
+            rows = max(len(timings), 1)
+            sample = ((time.perf_counter() - start) * 1000 / rows, queries[0] / rows)
+            for row in range(rows):
+                self.add(phase, *sample)
+            for row_timings in timings:
+                row_timings[phase] = sample
+
+    def get_queries(self):
+        """
+        Total queries per phase
+        """
+        return {phase: totals[1] for phase, totals in self.totals.items()}
+
+    @staticmethod
+    def percentile(values, percent):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+    def get_table(self):
+        output = [
+            "| Phase | Samples | p50 ms | p95 ms | Queries per sample |",
+            "|---|---|---|---|---|",
+        ]
+        for phase, (samples, queries) in self.totals.items():
+            output.append("| {0} | {1} | {2:.2f} | {3:.2f} | {4:.2f} |".format(
+                phase,
+                samples,
+                self.percentile(self.reservoirs[phase], 50),
+                self.percentile(self.reservoirs[phase], 95),
+                queries / samples,
+            ))
+        return "\n".join(output)
+
+
+class AllocationLocks:
+    """
+    Postgres advisory locks around allocation, concurrent runs never hand out the same name or address
+
+    Every key a chunk allocates from, hostname prefixes and pool prefixes alike, is taken in
+    one sorted statement before the chunk writes anything, so two runs can not deadlock on them.
+    They are transaction level and end with the chunk's own transaction.
+    """
+
+    @staticmethod
+    def get_key(namespace, name):
+        digest = hashlib.blake2b("{0}:{1}".format(namespace, name).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    @classmethod
+    def acquire(cls, names):
+        """
+        Lock (namespace, name) pairs
+        """
+        # Only Postgres has advisory locks, outside a transaction the lock would end with the statement
+        if connection.vendor != 'postgresql' or not connection.in_atomic_block:
+            return
+
+        keys = sorted(set(cls.get_key(namespace, name) for namespace, name in names))
+        if len(keys) == 0:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(key) FROM (SELECT unnest(%s::bigint[]) AS key ORDER BY key) AS keys",
+                [keys],
+            )
+
+
+class HostnameAllocator:
+    """
+    Hands out `site-env-role-NNN` hostnames for a whole batch
+
+    The highest index in use for every prefix is read in one aggregate query,
+    after that consecutive indices are handed out from memory
+    """
+
+    def __init__(self):
+        self.last_index = {}
+        self.reserved = set()
+
+    def reserve(self, names):
+        # Names given explicitly in the batch are skipped when allocating
+        self.reserved.update(names)
+
+    def forget(self, prefixes):
+        for prefix in prefixes:
+            self.last_index.pop(prefix, None)
+
+    def preload(self, prefixes):
+        prefixes = sorted(set(prefixes) - set(self.last_index))
+        if len(prefixes) == 0:
+            return
+
+        query = Q()
+        aggregates = {}
+        for i, prefix in enumerate(prefixes):
+            match = Q(name__regex=r'^{0}[0-9]{{1,9}}$'.format(re.escape(prefix)))
+            query |= match
+            aggregates['index_{0}'.format(i)] = Max(Cast(Substr('name', len(prefix) + 1), IntegerField()), filter=match)
+
+        result = VirtualMachine.objects.filter(query).aggregate(**aggregates)
+        for i, prefix in enumerate(prefixes):
+            self.last_index[prefix] = result['index_{0}'.format(i)] or 0
+
+    def allocate(self, prefix):
+        if prefix not in self.last_index:
+            # Only prefixes preloaded by a run are locked against other runs
+            self.preload([prefix])
+
+        index = self.last_index[prefix] + 1
+        while "{0}{1:03d}".format(prefix, index) in self.reserved:
+            index += 1
+        self.last_index[prefix] = index
+
+        hostname = "{0}{1:03d}".format(prefix, index)
+        self.reserved.add(hostname)
+        return hostname
+
+
+class IPPoolAllocator:
+    """
+    Reserves addresses from VLAN pool prefixes for a whole batch
+
+    The addresses in use within a prefix are read once into an IPSet,
+    free addresses are then handed out from memory in order
+    """
+
+    def __init__(self):
+        self.available = {}
+        self.marked = []
+
+    def mark_pool(self, prefix):
+        if not prefix.is_pool:
+            prefix.is_pool = True
+            # Save as pool
+            prefix.save()
+            self.marked.append(prefix)
+
+    def rollback(self, marked):
+        # Prefixes marked in a rolled back transaction are marked again on next use
+        for prefix in self.marked[marked:]:
+            prefix.is_pool = False
+        del self.marked[marked:]
+
+    def forget(self, prefixes):
+        for prefix in prefixes:
+            self.available.pop(prefix.pk, None)
+
+    def preload(self, prefixes):
+        prefixes = sorted(set(prefix for prefix in prefixes if prefix.pk not in self.available), key=lambda prefix: prefix.pk)
+        if len(prefixes) == 0:
+            return
+        for prefix in prefixes:
+            self.load(prefix)
+
+    def load(self, prefix):
+        network = netaddr.IPNetwork(str(prefix.prefix))
+        used = netaddr.IPSet([address.ip for address in prefix.get_child_ips().values_list('address', flat=True)])
+        available = netaddr.IPSet(network) - used
+        self.available[prefix.pk] = (network.prefixlen, iter(available))
+
+    def reserve(self, prefix, count):
+        if prefix.pk not in self.available:
+            self.preload([prefix])
+
+        prefixlen, available = self.available[prefix.pk]
+        addresses = []
+        for ip in available:
+            addresses.append("{0}/{1}".format(ip, prefixlen))
+            if len(addresses) == count:
+                return addresses
+        raise Exception("Prefix {0} has {1} of {2} requested addresses available".format(prefix, len(addresses), count))
+
+    def allocate(self, prefix):
+        return self.reserve(prefix, 1)[0]
+
+
+class PrefixIndex:
+    """
+    Longest prefix match over the pool prefixes of a site, in memory
+
+    Prefixes of a site are loaded once with their VLANs and kept per IP version and
+    prefix length as sorted intervals, a lookup is one bisect per prefix length.
+    The same load maps (site, vid) to the VLAN and its prefixes.
+    """
+
+    def __init__(self):
+        self.sites = {}
+        self.vlans = {}
+
+    def load(self, sites):
+        sites = [site for site in sites if site.pk not in self.sites]
+        if len(sites) == 0:
+            return
+
+        for site in sites:
+            self.sites[site.pk] = {}
+        # Prefixes with a VLAN may be marked as pool while the run writes
+        prefixes = Prefix.objects.filter(
+            Q(is_pool=True) | Q(vlan__isnull=False),
+            site__in=sites,
+        ).select_related('vlan')
+        for prefix in prefixes:
+            network = netaddr.IPNetwork(str(prefix.prefix))
+            firsts, entries = self.sites[prefix.site_id].setdefault((network.version, network.prefixlen), ([], []))
+            i = bisect_right(firsts, network.first)
+            firsts.insert(i, network.first)
+            entries.insert(i, (network.last, prefix))
+            if prefix.vlan is not None:
+                self.vlans.setdefault((prefix.site_id, prefix.vlan.vid), (prefix.vlan, []))[1].append(prefix)
+
+    def get_vlan(self, site, vid):
+        if site.pk not in self.sites:
+            self.load([site])
+        return self.vlans.get((site.pk, vid), (None, []))
+
+    def lookup(self, site, address):
+        """
+        Prefixes of the site containing address, longest first
+        """
+        if site.pk not in self.sites:
+            self.load([site])
+
+        ip = netaddr.IPNetwork(str(address))
+        for (version, prefixlen), (firsts, entries) in sorted(self.sites[site.pk].items(), key=lambda item: -item[0][1]):
+            if version != ip.version or prefixlen > ip.prefixlen:
+                continue
+            i = bisect_right(firsts, ip.value) - 1
+            # Equal prefixes in different VRFs sit next to each other
+            while i >= 0 and firsts[i] <= ip.value <= entries[i][0]:
+                yield entries[i][1]
+                i -= 1
+
+
+class CapacityPlanner:
+    """
+    Places VMs on the least loaded cluster and datazone
+
+    Current vcpus, memory and disk totals per cluster and datazone are read in one
+    aggregate query, the totals are then kept up to date in memory as rows are placed
+    """
+
+    RESOURCES = ('memory', 'vcpus', 'disk')
+    DATAZONES = ('1', '2')
+
+    def __init__(self):
+        self.clusters = {}
+        self.totals = {}
+
+    def load(self, clusters):
+        clusters = [cluster for cluster in clusters if cluster.pk not in self.clusters]
+        if len(clusters) == 0:
+            return
+
+        for cluster in clusters:
+            self.clusters[cluster.pk] = cluster
+            for datazone in self.DATAZONES + (None,):
+                self.totals[(cluster.pk, datazone)] = [0] * len(self.RESOURCES)
+
+        # One row per cluster and datazone tag, VMs without a datazone are grouped under None
+        datazone = VirtualMachine.tags.through.objects.filter(
+            content_type=ContentType.objects.get_for_model(VirtualMachine),
+            object_id=OuterRef('pk'),
+            tag__name__startswith='datazone_',
+        ).values('tag__name')[:1]
+        totals = VirtualMachine.objects.filter(
+            cluster__in=clusters
+        ).annotate(
+            datazone=Subquery(datazone)
+        ).values('cluster', 'datazone').annotate(
+            **{resource: Sum(resource) for resource in self.RESOURCES}
+        ).order_by()
+
+        for row in totals:
+            datazone = row['datazone'].split('datazone_')[1] if row['datazone'] is not None else None
+            key = (row['cluster'], datazone if datazone in self.DATAZONES else None)
+            for i, resource in enumerate(self.RESOURCES):
+                self.totals[key][i] += row[resource] or 0
+
+    def get_load(self, cluster):
+        # Memory is compared first, it runs out before cpu and disk
+        return tuple(sum(self.totals[(cluster, datazone)][i] for datazone in self.DATAZONES + (None,)) for i in range(len(self.RESOURCES)))
+
+    def place(self, row, clusters=None):
+        """
+        Set cluster and datazone of a row where they are left to placement, and count the row in
+        """
+        if row.get('cluster') is None and clusters:
+            row['cluster'] = self.clusters[min((cluster.pk for cluster in clusters), key=self.get_load)]
+        if not isinstance(row.get('cluster'), Cluster) or row['cluster'].pk not in self.clusters:
+            return row
+
+        cluster = row['cluster'].pk
+        if row.get('datazone') == 'capacity':
+            row['datazone'] = min(self.DATAZONES, key=lambda datazone: tuple(self.totals[(cluster, datazone)]))
+
+        datazone = str(row.get('datazone'))
+        totals = self.totals[(cluster, datazone if datazone in self.DATAZONES else None)]
+        for i, resource in enumerate(self.RESOURCES):
+            try:
+                totals[i] += int(row.get(resource) or 0)
+            except (TypeError, ValueError):
+                # Reported when the row itself is created
+                continue
+        return row
+
+
+class ChunkJobQueue:
+    """
+    Queues the chunk jobs of a background import on NetBox's job queue
+    """
+
+    def enqueue(self, script, data, commit):
+        JobResult.enqueue_job(
+            run_script,
+            script.full_name,
+            ContentType.objects.get(app_label='extras', model='script'),
+            script.request.user,
+            data=data,
+            request=copy_safe_request(script.request),
+            commit=commit,
+        )
+
+
+class InProcessChunkQueue(ChunkJobQueue):
+    """
+    Stand-in for the job queue that runs every chunk job right away in this process
+    """
+
+    def __init__(self):
+        self.scripts = []
+
+    def enqueue(self, script, data, commit):
+        chunk_script = type(script)()
+        chunk_script.request = getattr(script, 'request', None)
+        chunk_script.run(data, commit)
+        self.scripts.append(chunk_script)
+
+
+class ChangeLogBuffer:
+    """
+    Collects change records of bulk written objects and writes them at once
+
+    bulk_create and bulk_update send no signals, so NetBox does not log these writes itself.
+    Every object gets one record with its final state and at most one webhook job per
+    webhook and flush, webhooks are looked up once per model and action.
+    """
+
+    WEBHOOK_FLAGS = {
+        ObjectChangeActionChoices.ACTION_CREATE: 'type_create',
+        ObjectChangeActionChoices.ACTION_UPDATE: 'type_update',
+    }
+
+    def __init__(self, request=None):
+        self.request = request
+        self.changes = []
+
+    def add(self, instances, action):
+        self.changes += [(instance, action) for instance in instances]
+
+    def flush(self):
+        if len(self.changes) == 0:
+            return
+
+        user = self.request.user if self.request is not None else None
+        request_id = self.request.id if self.request is not None else uuid.uuid4()
+
+        # The record holds the tags, read them fresh for all objects of a model at once
+        models = defaultdict(list)
+        for instance, action in self.changes:
+            models[type(instance)].append(instance)
+        for model, instances in models.items():
+            if hasattr(model, 'tags'):
+                for instance in instances:
+                    getattr(instance, '_prefetched_objects_cache', {}).pop('tags', None)
+                prefetch_related_objects(instances, 'tags')
+
+        records = []
+        for instance, action in self.changes:
+            record = instance.to_objectchange(action)
+            record.user = user
+            record.user_name = user.username if user is not None else ''
+            record.request_id = request_id
+            records.append(record)
+        ObjectChange.objects.bulk_create(records)
+
+        # Webhooks are looked up once per model and action, not per object
+        batches = defaultdict(dict)
+        for instance, action in self.changes:
+            batches[(type(instance), action)][instance.pk] = instance
+        timestamp = str(timezone.now())
+        for (model, action), instances in batches.items():
+            webhooks = list(Webhook.objects.filter(
+                content_types=ContentType.objects.get_for_model(model),
+                enabled=True,
+                **{self.WEBHOOK_FLAGS[action]: True}
+            ))
+            if len(webhooks) == 0:
+                continue
+            # Same payload as NetBox's enqueue_webhooks, one object per job
+            serializer = get_serializer_for_model(model)
+            queue = get_queue('default')
+            for instance in instances.values():
+                data = serializer(instance, context={'request': None}).data
+                for webhook in webhooks:
+                    queue.enqueue(
+                        "extras.webhooks_worker.process_webhook",
+                        webhook,
+                        data,
+                        model._meta.model_name,
+                        action,
+                        timestamp,
+                        user.username if user is not None else '',
+                        request_id,
+                    )
+
+        self.changes = []
+
+
+class ServiceBuffer:
+    """
+    Prometheus exporter services of a batch, written with one insert per table
+
+    Exporter templates are expanded once per config context profile and alert type,
+    every VM of the profile then gets a copy with its own VM and IP address.
+    """
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.templates = {}
+        self.services = []
+        self.addresses = []
+        self.tags = []
+
+    def get_templates(self, vm):
+        key = (vm.get_profile(), vm.site.pk, vm.env.pk, vm.role.pk, vm.prom_alert_type)
+        if key not in self.templates:
+            exporters = vm.get_config_context().get('prometheus_exporters') or {}
+            self.resolver.preload(Tag, [tag for exporter in exporters.values() for tag in exporter.get('tags') or []])
+
+            templates = []
+            for name, exporter in exporters.items():
+                templates.append((
+                    name,
+                    dict(
+                        ports=exporter.get('ports'),
+                        protocol=exporter.get('protocol'),
+                        custom_field_data=dict(
+                            prom_location=vm.site.slug,
+                            prom_env=vm.get_prometheus_env(),
+                            prom_class=vm.role.name,
+                            prom_alert_type=vm.prom_alert_type,
+                            prom_metrics_path=exporter.get('metrics_path'),
+                            prom_ignore=False,
+                        ),
+                    ),
+                    [self.resolver.get(Tag, "{0}".format(tag)) for tag in exporter.get('tags') or []],
+                ))
+            self.templates[key] = templates
+        return self.templates[key]
+
+    def add(self, vm, virtual_machine: VirtualMachine, names=None):
+        for name, fields, tags in self.get_templates(vm):
+            if names is not None and name not in names:
+                continue
+            self.services.append(Service(
+                name=name,
+                virtual_machine_id=virtual_machine.pk,
+                ports=list(fields['ports'] or []),
+                protocol=fields['protocol'],
+                custom_field_data=dict(fields['custom_field_data']),
+            ))
+            self.addresses.append(virtual_machine.primary_ip4_id)
+            self.tags.append(tags)
+
+    def flush(self):
+        """
+        Write the services with their address and tag links, returns the services written
+        """
+        if len(self.services) == 0:
+            return []
+
+        services = Service.objects.bulk_create(self.services)
+
+        service_address = Service.ipaddresses.through
+        service_address.objects.bulk_create([
+            service_address(service_id=service.pk, ipaddress_id=address)
+            for service, address in zip(services, self.addresses)
+            if address is not None
+        ])
+
+        tagged_item = Service.tags.through
+        content_type = self.resolver.get_content_type(Service)
+        tagged_item.objects.bulk_create([
+            tagged_item(content_type=content_type, object_id=service.pk, tag=tag)
+            for service, tags in zip(services, self.tags)
+            for tag in tags
+        ])
+
+        self.services = []
+        self.addresses = []
+        self.tags = []
+        return services
+
+
+class VMPlan:
+    """
+    Compact result of planning one row, IDs and short interned strings only
+
+    ORM objects are only built from it at write time, see VM.from_plan
+    """
+
+    __slots__ = (
+        'line', 'status', 'tenant_id', 'cluster_id', 'site_id', 'platform_id', 'role_id', 'prom_alert_type',
+        'datazone_id', 'env_id', 'backup_id', 'backup_offsite_id', 'vcpus', 'memory', 'disk', 'hostname',
+        'csv_address', 'address', 'vlan_id', 'pool_prefix_id', 'extra_tags',
+    )
+
+    def __init__(self, **kwargs):
+        for slot in self.__slots__:
+            value = kwargs.get(slot)
+            setattr(self, slot, sys.intern(value) if isinstance(value, str) else value)
+
+    def get_tag_names(self):
+        return list(VM.DEFAULT_TAGS) + list(self.extra_tags or ())
+
+
+class VMResolver:
+    """
+    Run scoped cache of the reference data looked up by VM
+
+    Rows referenced by the CSV are loaded with a few bulk `__in` queries,
+    names that do not exist are cached as misses so they are only looked up once
+    """
+
+    LOOKUP_FIELDS = {
+        Cluster: 'name',
+        Tenant: 'slug',
+        Platform: 'name',
+        DeviceRole: 'name',
+        Tag: 'name',
+    }
+
+    def __init__(self, read_only=False, request=None, locking=False):
+        # A read only resolver never writes, not even missing tags
+        self.read_only = read_only
+        # Allocation is locked against other runs when chunks commit on their own
+        self.locking = locking and not read_only
+        self.request = request
+        self.cache = {model: {} for model in self.LOOKUP_FIELDS}
+        self.objects = defaultdict(dict)
+        self.created_tags = []
+        self.hostnames = HostnameAllocator()
+        self.ip_pools = IPPoolAllocator()
+        self.capacity = CapacityPlanner()
+        self.prefixes = PrefixIndex()
+        self.content_types = {}
+        self.stats = RunStats()
+        self.checked_addresses = set()
+        self.vrf = None
+        self.config_contexts = {}
+        self.context_tags = None
+
+    @staticmethod
+    def env_tag_name(env):
+        return env if isinstance(env, Tag) else "env_{0}".format(env)
+
+    @staticmethod
+    def datazone_tag_name(datazone):
+        return datazone if isinstance(datazone, Tag) else "datazone_{0}".format(datazone)
+
+    def preload(self, model, values):
+        cache = self.cache[model]
+        names = set(str(value) for value in values if value is not None and not isinstance(value, model)) - set(cache)
+        if len(names) == 0:
+            return
+
+        field = self.LOOKUP_FIELDS[model]
+        queryset = model.objects.filter(**{field + '__in': names})
+        if model is Cluster:
+            queryset = queryset.select_related('site')
+        for obj in queryset:
+            cache[getattr(obj, field)] = obj
+            self.remember(obj)
+
+        # Cache misses as well, a typo should only cost one query
+        for name in names:
+            cache.setdefault(name, None)
+
+    def check_prometheus_envs(self, rows):
+        """
+        (site, env) pairs of the batch without a prometheus env, as a list of conflicts
+
+        rows are (line, clusters, env). Only checked when a config context defines exporters.
+        """
+        if not ConfigContext.objects.filter(is_active=True, data__has_key='prometheus_exporters').exists():
+            return []
+
+        rows = list(rows)
+        self.preload(Cluster, [cluster for line, clusters, env in rows for cluster in clusters])
+        missing = defaultdict(list)
+        for line, clusters, env in rows:
+            if env is None:
+                continue
+            env = self.env_tag_name(env)
+            env = env.name if isinstance(env, Tag) else env
+            for cluster in clusters:
+                cluster = cluster if isinstance(cluster, Cluster) else self.cache[Cluster].get(str(cluster))
+                if cluster is None or cluster.site is None:
+                    # Reported when the row itself is created
+                    continue
+                if (cluster.site.name, env) not in VM.PROMETHEUS_ENVS:
+                    missing[(cluster.site.name, env)].append(line)
+
+        return [
+            "No prometheus env for site `{0}` and `{1}`, used on CSV lines {2}{3}".format(
+                site, env, ", ".join(str(line) for line in lines[:10]), " and {0} more".format(len(lines) - 10) if len(lines) > 10 else "",
+            )
+            for (site, env), lines in sorted(missing.items())
+        ]
+
+    def get_context_tags(self):
+        """
+        Slugs of the tags active config contexts are assigned to, read once per run
+        """
+        if self.context_tags is None:
+            self.context_tags = set(ConfigContext.objects.filter(is_active=True, tags__isnull=False).values_list('tags__slug', flat=True))
+        return self.context_tags
+
+    def get_content_type(self, model):
+        if model not in self.content_types:
+            self.content_types[model] = ContentType.objects.get_for_model(model)
+        return self.content_types[model]
+
+    def get_pool_prefix(self, site, address, pool=None):
+        """
+        Longest pool prefix of the site containing address, pools marked in this run included
+
+        A read only run marks nothing, there the prefix the address was allocated from counts as a pool
+        """
+        marked = set(prefix.pk for prefix in self.ip_pools.marked)
+        if self.read_only and pool is not None:
+            marked.add(pool.pk)
+        for prefix in self.prefixes.lookup(site, address):
+            if prefix.is_pool or prefix.pk in marked:
+                return prefix
+        raise Exception("No pool prefix in site {0} contains {1}".format(site, address))
+
+    def get_vlan(self, site, vid):
+        """
+        VLAN of the site by vid, from the prefix index
+        """
+        vlan, prefixes = self.prefixes.get_vlan(site, int(vid))
+        if vlan is None:
+            raise Exception("VLAN {0} with a prefix does not exist in site {1}".format(vid, site))
+        return vlan
+
+    def get_vlan_prefix(self, site, vlan):
+        vlan, prefixes = self.prefixes.get_vlan(site, vlan.vid)
+        if len(prefixes) != 1:
+            raise Exception("VLAN {0} has {1} prefixes in site {2}, expected one".format(vlan, len(prefixes), site))
+        return prefixes[0]
+
+    def remember(self, *objs):
+        for obj in objs:
+            if obj is not None:
+                self.objects[type(obj)][obj.pk] = obj
+
+    def get_by_id(self, model, pk):
+        """
+        Objects a plan refers to by ID, served from the cache
+        """
+        if pk is None:
+            return None
+        if pk not in self.objects[model]:
+            self.remember(model.objects.get(pk=pk))
+        return self.objects[model][pk]
+
+    def place_rows(self, rows, clusters=None):
+        """
+        Place rows without a cluster on the least loaded of clusters, and rows with
+        datazone `capacity` on the least loaded datazone of their cluster
+        """
+        clusters = list(clusters or [])
+        self.preload(Cluster, [row.get('cluster') for row in rows])
+
+        named = []
+        for row in rows:
+            if row.get('cluster') is not None and not isinstance(row.get('cluster'), Cluster):
+                row['cluster'] = self.cache[Cluster].get(str(row.get('cluster'))) or row.get('cluster')
+            if row.get('datazone') == 'capacity' and isinstance(row.get('cluster'), Cluster):
+                named.append(row.get('cluster'))
+        self.capacity.load(clusters + named)
+
+        for row in rows:
+            self.capacity.place(row, clusters)
+        return rows
+
+    def preload_rows(self, rows):
+        self.preload(Cluster, [row.get('cluster') for row in rows])
+        self.preload(Tenant, [row.get('tenant') for row in rows])
+        self.preload(Platform, [row.get('platform') for row in rows])
+        self.preload(DeviceRole, [row.get('role') for row in rows])
+
+        tags = []
+        for row in rows:
+            tags.append(self.env_tag_name(row.get('env')))
+            tags.append(self.datazone_tag_name(row.get('datazone')))
+            tags.append(row.get('backup'))
+            tags.append(row.get('backup_offsite'))
+            if row.get('extra_tags') is not None:
+                tags += row.get('extra_tags').split(',')
+        tags += VM.DEFAULT_TAGS
+        self.preload(Tag, tags)
+
+        prefixes = []
+        for row in rows:
+            if row.get('hostname') is not None:
+                continue
+            try:
+                prefixes.append(VM.hostname_prefix(
+                    site=self.get(Cluster, row.get('cluster')).site,
+                    env=self.get(Tag, self.env_tag_name(row.get('env'))),
+                    role=self.get(DeviceRole, row.get('role')),
+                ))
+            except Exception:
+                # Reported when the row itself is created
+                continue
+        self.hostnames.reserve([row.get('hostname') for row in rows if row.get('hostname') is not None])
+
+        clusters = [self.cache[Cluster].get(str(row.get('cluster'))) if not isinstance(row.get('cluster'), Cluster) else row.get('cluster') for row in rows]
+        self.prefixes.load(set(cluster.site for cluster in clusters if cluster is not None and cluster.site is not None))
+
+        pools = []
+        for row, cluster in zip(rows, clusters):
+            if row.get('vlan') is None or row.get('ip_address') is not None or cluster is None:
+                continue
+            try:
+                vlan = row.get('vlan') if isinstance(row.get('vlan'), VLAN) else self.get_vlan(cluster.site, row.get('vlan'))
+                pools.append(self.get_vlan_prefix(cluster.site, vlan))
+            except Exception:
+                # Reported when the row itself is created
+                continue
+
+        if self.locking:
+            # All keys of the chunk at once, then read again what other runs allocated since the last chunk
+            AllocationLocks.acquire([('hostname', prefix) for prefix in prefixes] + [('prefix', pool.pk) for pool in pools])
+            self.hostnames.forget(prefixes)
+            self.ip_pools.forget(pools)
+        self.hostnames.preload(prefixes)
+        self.ip_pools.preload(pools)
+
+    def preflight(self, rows, reconcile=False):
+        """
+        Check every CSV IP address and hostname against the database and the rest of the batch
+
+        When reconciling, existing hostnames are updated and keep their own primary address.
+        Returns a list of conflicts, empty if the batch can be written
+        """
+        addresses = defaultdict(list)
+        hostnames = defaultdict(list)
+        address_hostnames = dict()
+        self.rows = 0
+        for line, row in enumerate(rows, start=1):
+            self.rows = line
+            if row.get('ip_address') is not None:
+                addresses[row.get('ip_address')].append(line)
+                address_hostnames[row.get('ip_address')] = row.get('hostname')
+            if row.get('hostname') is not None:
+                hostnames[row.get('hostname')].append(line)
+
+        conflicts = []
+        for address, lines in addresses.items():
+            if len(lines) > 1:
+                conflicts.append("IP address `{0}` is used on CSV lines {1}".format(address, ", ".join(str(line) for line in lines)))
+        for hostname, lines in hostnames.items():
+            if len(lines) > 1:
+                conflicts.append("Hostname `{0}` is used on CSV lines {1}".format(hostname, ", ".join(str(line) for line in lines)))
+
+        existing = dict()
+        if len(hostnames) > 0:
+            existing = dict(VirtualMachine.objects.filter(name__in=list(hostnames)).values_list('name', 'primary_ip4__address'))
+            if not reconcile:
+                for hostname in existing:
+                    conflicts.append("Hostname `{0}` on CSV line {1} already exists".format(hostname, hostnames[hostname][0]))
+        if len(addresses) > 0:
+            for address in IPAddress.objects.filter(address__in=list(addresses)).values_list('address', flat=True):
+                address = str(address)
+                if reconcile and address in address_hostnames and str(existing.get(address_hostnames[address])) == address:
+                    continue
+                conflicts.append("IP address `{0}` on CSV line {1} is already assigned".format(address, addresses[address][0] if address in addresses else "?"))
+
+        # Addresses checked here do not have to be checked again per row,
+        # hostnames given in any chunk must not be generated in another
+        self.checked_addresses.update(addresses)
+        self.hostnames.reserve(hostnames)
+        return conflicts
+
+    @contextmanager
+    def atomic(self):
+        """
+        transaction.atomic() that also forgets what the resolver wrote inside a rolled back block
+
+        Nested blocks are savepoints, hostnames and addresses handed out inside are not reused
+        """
+        created_tags = len(self.created_tags)
+        marked = len(self.ip_pools.marked)
+        try:
+            with transaction.atomic():
+                yield
+        except Exception:
+            for name in self.created_tags[created_tags:]:
+                self.cache[Tag].pop(name, None)
+            del self.created_tags[created_tags:]
+            self.ip_pools.rollback(marked)
+            raise
+
+    def get_vrf(self):
+        if self.vrf is None:
+            self.vrf = VRF.objects.get(
+                name="global"
+            )
+        return self.vrf
+
+    def get_tags(self, names):
+        """
+        Resolve tag names, tags that do not exist yet are created in one bulk insert
+
+        A read only resolver leaves out tags that do not exist. Created tags are change logged
+        here, every mode that creates tags goes through this method.
+        """
+        self.preload(Tag, names)
+        missing = sorted(set(name for name in names if self.cache[Tag][name] is None))
+        if len(missing) > 0 and not self.read_only:
+            tags = Tag.objects.bulk_create([Tag(name=name, slug=slugify(name)) for name in missing])
+            for tag in tags:
+                self.cache[Tag][tag.name] = tag
+                self.remember(tag)
+                self.created_tags.append(tag.name)
+            changelog = ChangeLogBuffer(self.request)
+            changelog.add(tags, ObjectChangeActionChoices.ACTION_CREATE)
+            changelog.flush()
+        return [self.cache[Tag][name] for name in names if self.cache[Tag][name] is not None]
+
+    def get(self, model, value):
+        if isinstance(value, model):
+            return value
+
+        name = str(value)
+        if name not in self.cache[model]:
+            self.preload(model, [name])
+
+        obj = self.cache[model][name]
+        if obj is None:
+            raise Exception("{0} '{1}' does not exist".format(model.__name__, name))
+        return obj
+
+
+class TagSlugs(list):
+    """
+    Stand-in for the tag manager of an unsaved object
+    """
+
+    def slugs(self):
+        return [tag.slug for tag in self]
+
+
+class ConfigContextTarget:
+    """
+    Unsaved VirtualMachine as ConfigContext.objects.get_for_object sees it
+
+    The tag manager of an unsaved object can not be read, the tags it will get are used instead
+    """
+
+    def __init__(self, virtual_machine, tags):
+        self.virtual_machine = virtual_machine
+        self.tags = TagSlugs(tags)
+
+    def __getattr__(self, name):
+        return getattr(self.virtual_machine, name)
 
 
 class VM:
@@ -27,6 +978,7 @@ class VM:
     DEFAULT_DOMAIN_PRIVATE = 'patientsky.zone'
     DEFAULT_DOMAIN_PUBLIC = 'patientsky.dev'
     DEFAULT_PROM_ALERT_TYPE = '24-7-devops'
+    PROM_ALERT_TYPES = ('24-7-devops', '37-5-devops', '24-7-voip', '37-5-voip')
 
     PROMETHEUS_DICT = dict(
         cph1=dict(
@@ -79,26 +1031,59 @@ class VM:
         )
     )
 
-    def __init__(self, status, tenant, cluster, prom_alert_type, datazone, env, platform, role, backup, backup_offsite, vcpus, memory, disk, ip_address, hostname, extra_tags):
+    # Flat (site, env tag) -> prom_env lookup, the pairs a batch uses are checked when a run starts
+    PROMETHEUS_ENVS = {
+        (site, env): values.get('prom_env')
+        for site, envs in PROMETHEUS_DICT.items()
+        for env, values in envs.items()
+    }
+
+    def __init__(self, status, tenant, cluster, prom_alert_type, datazone, env, platform, role, backup, backup_offsite, vcpus, memory, disk, ip_address, hostname, extra_tags, vlan=None, resolver=None):
+        # Lookups are served from the run cache, a standalone VM gets its own
+        self.resolver = resolver if resolver is not None else VMResolver()
+        self.timings = dict()
         # IP address can first be created after vm
         self.csv_ip_address = ip_address
-        self.set_cluster(cluster)
-        self.set_prom_alert_type(prom_alert_type)
-        self.set_status(status)
-        self.set_tenant(tenant)
-        self.set_datazone(datazone)
-        self.set_env(env)
-        self.set_platform(platform)
-        self.set_role(role)
-        self.set_backup_tag(backup)
-        self.set_backup_offsite_tag(backup_offsite)
-        self.set_vcpus(vcpus)
-        self.set_memory(memory)
-        self.set_disk(disk)
-        self.set_hostname(hostname)
-        self.set_vlan(None)
-        self.set_extra_tags(extra_tags)
-        self.set_comments()
+        for setter, value in (
+            (self.set_cluster, cluster),
+            (self.set_prom_alert_type, prom_alert_type),
+            (self.set_status, status),
+            (self.set_tenant, tenant),
+            (self.set_datazone, datazone),
+            (self.set_env, env),
+            (self.set_platform, platform),
+            (self.set_role, role),
+            (self.set_backup_tag, backup),
+            (self.set_backup_offsite_tag, backup_offsite),
+            (self.set_vcpus, vcpus),
+            (self.set_memory, memory),
+            (self.set_disk, disk),
+            (self.set_hostname, hostname),
+            (self.set_vlan, vlan),
+            (self.set_extra_tags, extra_tags),
+        ):
+            with self.measure(setter.__name__):
+                setter(value)
+        with self.measure('set_comments'):
+            self.set_comments()
+
+    def measure(self, phase):
+        return self.resolver.stats.measure(phase, timings=[self.timings])
+
+    def get_timings(self):
+        """
+        Per row figures for the log, lookups done while constructing are summed up
+
+        VMs built from a plan did their lookups while planning, they have no lookup figures
+        """
+        lookups = [timing for phase, timing in self.timings.items() if phase.startswith('set_')]
+        figures = []
+        if len(lookups) > 0:
+            figures.append("lookups {0:.1f} ms/{1:g} q".format(sum(timing[0] for timing in lookups), sum(timing[1] for timing in lookups)))
+        for phase, timing in self.timings.items():
+            if not phase.startswith('set_'):
+                figures.append("{0} {1:.1f} ms/{2:g} q".format(phase, timing[0], timing[1]))
+        return ", ".join(figures)
 
     def set_comments(self):
         try:
@@ -166,46 +1151,40 @@ class VM:
 
     def set_vlan(self, vlan):
         try:
-            self.vlan = VLAN.objects.get(
-                vid=vlan,
-                site=self.site
-            )
-        except Exception:
-            self.vlan = None
+            if vlan is None or vlan == '':
+                self.vlan = None
+            elif isinstance(vlan, VLAN):
+                self.vlan = vlan
+            else:
+                self.vlan = self.resolver.get_vlan(self.site, vlan)
+        except Exception as e:
+            raise Exception("VLAN does not exist {0}".format(e))
+
+    @staticmethod
+    def hostname_prefix(site, env, role):
+        return "{0}-{1}-{2}-".format(site.slug, env.name.split('_')[1], role.name.split(':')[0])
 
     def generate_hostname(self):
         # I now proclaim this VM, First of its Name, Queen of the Andals and the First Men, Protector of the Seven Kingdoms
-        vm_index = "001"
-        vm_search_for = "{0}-{1}-{2}-".format(self.site.slug, self.env.name.split('_')[1], self.role.name.split(':')[0])
-        vms = VirtualMachine.objects.filter(
-            name__startswith=vm_search_for
-        )
-        if len(vms) > 0:
-            # Get last of its kind
-            last_vm_index = int(vms[len(vms) - 1].name.split('-')[3]) + 1
-            if last_vm_index < 10:
-                vm_index = '00' + str(last_vm_index)
-            elif last_vm_index < 100:
-                vm_index = '0' + str(last_vm_index)
-            else:
-                vm_index = str(last_vm_index)
-
-        return "{0}{1}".format(vm_search_for, vm_index)
+        return self.resolver.hostnames.allocate(self.hostname_prefix(self.site, self.env, self.role))
 
     def get_vrf(self):
-        return VRF.objects.get(
-            name="global"
-        )
+        return self.resolver.get_vrf()
 
     def get_fqdn(self):
         return "{}.{}".format(self.hostname, self.DEFAULT_DOMAIN_PRIVATE if netaddr.IPNetwork(self.ip_address.address).is_private() is True else self.DEFAULT_DOMAIN_PUBLIC)
 
-    def set_ip_address(self, vm):
+    def __build_ip_address(self):
+        self.pool_prefix = None
         try:
-            ip_check = IPAddress.objects.filter(address=self.csv_ip_address)
-            if len(ip_check) > 0:
-                raise Exception(str(ip_check[0].address) + ' is already assigned')
-            if not isinstance(self.vlan, VLAN):
+            if self.csv_ip_address in (None, ''):
+                if not isinstance(self.vlan, VLAN):
+                    raise Exception("ip_address or vlan is required")
+            elif self.csv_ip_address not in self.resolver.checked_addresses:
+                ip_check = IPAddress.objects.filter(address=self.csv_ip_address)
+                if len(ip_check) > 0:
+                    raise Exception(str(ip_check[0].address) + ' is already assigned')
+            if self.csv_ip_address not in (None, ''):
                 self.ip_address = IPAddress(
                     address=self.csv_ip_address,
                     vrf=self.get_vrf(),
@@ -213,23 +1192,27 @@ class VM:
                 )
             else:
                 # Auto assign IPs from vlan
-                prefix = Prefix.objects.get(
-                    vlan=self.vlan,
-                    site=vm.site
-                )
-                prefix.is_pool = True
-                # Save as pool
-                prefix.save()
+                self.pool_prefix = self.resolver.get_vlan_prefix(self.site, self.vlan)
 
-                ip_address = prefix.get_first_available_ip()
+                ip_address = self.resolver.ip_pools.allocate(self.pool_prefix)
                 self.ip_address = IPAddress(
                     address=ip_address,
                     vrf=self.get_vrf(),
                     tenant=self.tenant,
                 )
-            self.ip_address.dns_name = self.get_fqdn()
-            self.ip_address.save()
+            self.ip_address.dns_name = self.get_fqdn().lower()
+
+        except Exception as e:
+            self.ip_address = None
+            raise Exception("IP address - {0}".format(e))
+        return self.ip_address
 
+    def set_ip_address(self, vm):
+        self.__build_ip_address()
+        try:
+            if self.pool_prefix is not None:
+                self.resolver.ip_pools.mark_pool(self.pool_prefix)
+            self.ip_address.save()
         except Exception as e:
             self.ip_address = None
             raise Exception("IP address - {0}".format(e))
@@ -266,7 +1249,7 @@ class VM:
             if isinstance(backup, Tag):
                 self.backup = backup
             else:
-                self.backup = Tag.objects.filter(name="{0}".format(backup))[0]
+                self.backup = self.resolver.get(Tag, "{0}".format(backup))
         except Exception as e:
             raise Exception("Tag backup {0} does not exist, {1}".format(backup, e))
 
@@ -275,7 +1258,7 @@ class VM:
             if isinstance(backup_offsite, Tag):
                 self.backup_offsite = backup_offsite
             else:
-                self.backup_offsite = Tag.objects.filter(name="{0}".format(backup_offsite))[0]
+                self.backup_offsite = self.resolver.get(Tag, "{0}".format(backup_offsite))
         except Exception:
             self.backup_offsite = None
 
@@ -290,64 +1273,45 @@ class VM:
 
     def set_role(self, role):
         try:
-            self.role = DeviceRole.objects.get(
-                name=role
-            )
+            self.role = self.resolver.get(DeviceRole, role)
         except Exception as e:
             raise Exception('Role does not exist - ' + str(e))
 
     def set_platform(self, platform):
         try:
-            if isinstance(platform, Platform):
-                self.platform = platform
-            else:
-                self.platform = Platform.objects.get(
-                    name=platform
-                )
+            self.platform = self.resolver.get(Platform, platform)
         except Exception as e:
             raise Exception("Platform does not exist {0}".format(e))
 
     def set_env(self, env):
         try:
-            if isinstance(env, Tag):
-                self.env = env
-            else:
-                self.env = Tag.objects.get(name="env_{0}".format(env))
+            self.env = self.resolver.get(Tag, self.resolver.env_tag_name(env))
         except Exception as e:
             raise Exception("Tag env does not exist! - {0}".format(e))
 
     def set_datazone(self, datazone):
         try:
-            self.datazone = Tag.objects.get(name="datazone_{0}".format(datazone))
+            self.datazone = self.resolver.get(Tag, self.resolver.datazone_tag_name(datazone))
         except Exception as e:
             raise Exception("Tag datazone does not exist! - {0}".format(e))
 
     def set_cluster(self, cluster):
         try:
-            if isinstance(cluster, Cluster):
-                self.cluster = cluster
-            else:
-                self.cluster = Cluster.objects.get(
-                    name=cluster
-                )
+            self.cluster = self.resolver.get(Cluster, cluster)
             self.set_site(self.cluster.site)
         except Exception as e:
             raise Exception("Cluster does not exist {0}".format(e))
 
     def set_tenant(self, tenant):
         try:
-            if isinstance(tenant, Tenant):
-                self.tenant = tenant
-            else:
-                self.tenant = Tenant.objects.get(
-                    slug=tenant
-                )
+            self.tenant = self.resolver.get(Tenant, tenant)
         except Exception as e:
             raise Exception("Tenant does not exist {0}".format(e))
 
     def set_status(self, status):
         try:
-            self.status = VirtualMachineStatusChoices.STATUS_STAGED if status == 'staged' else VirtualMachineStatusChoices.STATUS_PLANNED
+            # Any VM status imports as is, so exported VMs can be imported again
+            self.status = status if status in VirtualMachineStatusChoices.values() else VirtualMachineStatusChoices.STATUS_PLANNED
         except Exception as e:
             raise Exception("Status does not exist {0}".format(e))
 
@@ -359,17 +1323,68 @@ class VM:
         vm.primary_ip4 = self.get_ip_address()
         vm.save()
 
-    def __create_tags(self, vm: VirtualMachine):
-        vm.tags.add(self.datazone)
-        vm.tags.add(self.env)
-        vm.tags.add(self.backup)
-        if(self.backup_offsite is not None):
-            vm.tags.add(self.backup_offsite)
-        for tag in self.DEFAULT_TAGS:
-            vm.tags.add(tag)
+    def get_tag_names(self):
+        """
+        Names of all tags the VM gets, including tags that are created on write
+        """
+        names = [tag.name for tag in (self.datazone, self.env, self.backup, self.backup_offsite) if tag is not None]
+        for name in self.__get_tag_names():
+            if name not in names:
+                names.append(name)
+        return names
+
+    def __get_tag_names(self):
+        names = list(self.DEFAULT_TAGS)
         if self.extra_tags is not None:
-            for tag in self.extra_tags:
-                vm.tags.add(tag)
+            names += self.extra_tags
+        return names
+
+    def __resolve_tags(self):
+        tags = [self.datazone, self.env, self.backup]
+        if(self.backup_offsite is not None):
+            tags.append(self.backup_offsite)
+        tags += self.resolver.get_tags(self.__get_tag_names())
+
+        # A tag can be both a default and an extra tag
+        unique = {}
+        for tag in tags:
+            unique.setdefault(tag.pk, tag)
+        return list(unique.values())
+
+    def get_profile(self):
+        """
+        VMs sharing a profile are matched by the same config contexts
+
+        Tags no config context is assigned to can not change the match and are left out
+        """
+        context_tags = self.resolver.get_context_tags()
+        return (
+            self.site.pk,
+            self.cluster.pk,
+            self.role.pk,
+            self.platform.pk,
+            self.tenant.pk,
+            tuple(sorted(tag.slug for tag in self.__resolve_tags() if tag.slug in context_tags)),
+        )
+
+    def __render_config_context(self):
+        # NetBox's own matching, on the unsaved VM with the tags it will get
+        contexts = ConfigContext.objects.get_for_object(ConfigContextTarget(self.__build_vm(), self.__resolve_tags()))
+
+        data = dict()
+        for context in contexts:
+            data = deepmerge(data, context.data)
+        return data
+
+    def get_config_context(self):
+        # Rendered once per profile and run, the result is shared and must not be changed
+        profile = self.get_profile()
+        if profile not in self.resolver.config_contexts:
+            self.resolver.config_contexts[profile] = self.__render_config_context()
+        return self.resolver.config_contexts[profile]
+
+    def __create_tags(self, vm: VirtualMachine):
+        vm.tags.add(*self.__resolve_tags())
         vm.save()
         self.set_tags(vm.tags)
 
@@ -382,8 +1397,8 @@ class VM:
             list.append(tag.name)
         return list
 
-    def __create_vm(self):
-        vm = VirtualMachine(
+    def __build_vm(self):
+        return VirtualMachine(
             status=self.status,
             cluster=self.cluster,
             platform=self.platform,
@@ -395,83 +1410,65 @@ class VM:
             vcpus=self.vcpus,
             comments=self.comments,
         )
+
+    def __create_vm(self):
+        vm = self.__build_vm()
         vm.save()
         return vm
 
-    def __create_interface(self, vm: VirtualMachine):
-        """
-        Setup interface and add IP address
-        """
-        try:
+    def __build_interface(self, vm: VirtualMachine):
+        prefix = self.resolver.get_pool_prefix(self.site, self.ip_address.address, pool=self.pool_prefix)
 
-            # Get net address tools
-            ip = netaddr.IPNetwork(vm.primary_ip4.address)
-            prefix_search = str(ip.network) + '/' + str(ip.prefixlen)
+        interfaces = self.get_config_context().get('interfaces')
 
-            prefix = Prefix.objects.get(
-                prefix=prefix_search,
-                is_pool=True,
-                site=self.site,
-            )
+        interface = VMInterface(
+            name=interfaces['nic0']['name'],
+            mtu=interfaces['nic0']['mtu'],
+            virtual_machine=vm
+        )
 
-            interfaces = vm.get_config_context().get('interfaces')
+        # If we need anything other than Access, here is were to change it
+        if interfaces['nic0']['mode'] == "Access":
+            interface.mode = InterfaceModeChoices.MODE_ACCESS
+            interface.untagged_vlan = prefix.vlan
 
-            interface = VMInterface(
-                name=interfaces['nic0']['name'],
-                mtu=interfaces['nic0']['mtu'],
-                virtual_machine=vm
-            )
+        return interface
 
-            # If we need anything other than Access, here is were to change it
-            if interfaces['nic0']['mode'] == "Access":
-                interface.mode = InterfaceModeChoices.MODE_ACCESS
-                interface.untagged_vlan = prefix.vlan
+    def __assign_ip_address(self, interface: VMInterface):
+        self.ip_address.assigned_object_type = self.resolver.get_content_type(VMInterface)
+        self.ip_address.assigned_object_id = interface.id
+        self.ip_address.assigned_object = interface
 
+    def __create_interface(self, vm: VirtualMachine):
+        """
+        Setup interface and add IP address
+        """
+        try:
+            interface = self.__build_interface(vm)
             interface.save()
 
-            type = ContentType.objects.get(app_label="virtualization", model="vminterface")
-            self.ip_address.assigned_object_type = type
-            self.ip_address.assigned_object_id = interface.id
-            self.ip_address.assigned_object = interface
+            self.__assign_ip_address(interface)
             self.ip_address.save()
 
         except Exception as e:
             raise Exception("Error while creating interface - {0}".format(e))
         return True
 
-    def __prometheus_env_translator(self, env: Tag, site: Site):
+    def get_prometheus_env(self):
         try:
-            return self.PROMETHEUS_DICT[site.name][env.name].get('prom_env')
+            return self.PROMETHEUS_ENVS[(self.site.name, self.env.name)]
         except Exception as e:
-            raise Exception("Error while translating prometheus env - error: {0} env: {1} site: {2}".format(e, env, site))
+            raise Exception("Error while translating prometheus env - error: {0} env: {1} site: {2}".format(e, self.env, self.site))
 
     def __create_service(self, vm):
-
         try:
+            services = ServiceBuffer(self.resolver)
+            services.add(self, vm)
 
-            services = vm.get_config_context().get('prometheus_exporters')
-
-            for name in services:
-                s = Service(
-                    name=name,
-                    virtual_machine_id=vm.id,
-                    ports=services[name].get('ports'),
-                    protocol=services[name].get('protocol'),
-                )
-                s.custom_field_data["prom_location"] = vm.site.slug
-                s.custom_field_data["prom_env"] = self.__prometheus_env_translator(site=self.site, env=self.env)
-                s.custom_field_data["prom_class"] = self.role.name
-                s.custom_field_data["prom_alert_type"] = self.prom_alert_type
-                s.custom_field_data["prom_metrics_path"] = services[name].get('metrics_path')
-                s.custom_field_data["prom_ignore"] = False
-
-                s.save()
-
-                # Set ip address
-                s.ipaddresses.add(vm.primary_ip4.id)
-                for tag in services[name].get('tags'):
-                    s.tags.add(Tag.objects.filter(name="{0}".format(tag))[0])
-                s.save()
+            # Bulk inserts send no signals, the change records are written here
+            changelog = ChangeLogBuffer(self.resolver.request)
+            changelog.add(services.flush(), ObjectChangeActionChoices.ACTION_CREATE)
+            changelog.flush()
 
         except Exception as e:
             raise Exception("Error while creating service - {0} {1}".format(e, vm))
@@ -479,15 +1476,365 @@ class VM:
 
     def create(self):
         try:
-            vm = self.__create_vm()
-            self.__create_ip_address(vm)
-            self.__create_tags(vm)
-            self.__create_interface(vm)
-            self.__create_service(vm)
+            with self.measure('create_vm'):
+                vm = self.__create_vm()
+            with self.measure('create_ip_address'):
+                self.__create_ip_address(vm)
+            with self.measure('create_tags'):
+                self.__create_tags(vm)
+            with self.measure('create_interface'):
+                self.__create_interface(vm)
+            with self.measure('create_service'):
+                self.__create_service(vm)
         except Exception as e:
             raise e
         return True
 
+    def build(self):
+        """
+        Build the VM and its IP address without writing anything
+        """
+        with self.measure('build'):
+            self.virtual_machine = self.__build_vm()
+            self.__build_ip_address()
+        return True
+
+    def to_plan(self, line=None):
+        """
+        Compact plan of a built VM, the VM itself is not needed after this
+        """
+        self.resolver.remember(self.tenant, self.cluster, self.site, self.platform, self.role, self.datazone, self.env, self.backup, self.backup_offsite, self.vlan, self.pool_prefix)
+        # The address is free, whether it was checked up front or allocated from a pool
+        self.resolver.checked_addresses.add(str(self.ip_address.address))
+        return VMPlan(
+            line=line,
+            status=self.status,
+            tenant_id=self.tenant.pk,
+            cluster_id=self.cluster.pk,
+            site_id=self.site.pk,
+            platform_id=self.platform.pk,
+            role_id=self.role.pk,
+            prom_alert_type=self.prom_alert_type,
+            datazone_id=self.datazone.pk,
+            env_id=self.env.pk,
+            backup_id=self.backup.pk,
+            backup_offsite_id=self.backup_offsite.pk if self.backup_offsite is not None else None,
+            vcpus=self.vcpus,
+            memory=self.memory,
+            disk=self.disk,
+            hostname=self.hostname,
+            csv_address=self.csv_ip_address,
+            address=str(self.ip_address.address),
+            vlan_id=self.vlan.pk if self.vlan is not None else None,
+            pool_prefix_id=self.pool_prefix.pk if self.pool_prefix is not None else None,
+            extra_tags=tuple(sys.intern(tag) for tag in self.extra_tags) if self.extra_tags is not None else None,
+        )
+
+    @classmethod
+    def from_plan(cls, plan: VMPlan, resolver):
+        """
+        Build the VM of a plan with its unsaved VirtualMachine and IP address
+        """
+        vm = cls.__new__(cls)
+        vm.resolver = resolver
+        vm.timings = dict()
+        vm.status = plan.status
+        vm.tenant = resolver.get_by_id(Tenant, plan.tenant_id)
+        vm.cluster = resolver.get_by_id(Cluster, plan.cluster_id)
+        vm.set_site(resolver.get_by_id(Site, plan.site_id))
+        vm.platform = resolver.get_by_id(Platform, plan.platform_id)
+        vm.role = resolver.get_by_id(DeviceRole, plan.role_id)
+        vm.prom_alert_type = plan.prom_alert_type
+        vm.datazone = resolver.get_by_id(Tag, plan.datazone_id)
+        vm.env = resolver.get_by_id(Tag, plan.env_id)
+        vm.backup = resolver.get_by_id(Tag, plan.backup_id)
+        vm.backup_offsite = resolver.get_by_id(Tag, plan.backup_offsite_id)
+        vm.vcpus = plan.vcpus
+        vm.memory = plan.memory
+        vm.disk = plan.disk
+        vm.hostname = plan.hostname
+        vm.extra_tags = list(plan.extra_tags) if plan.extra_tags is not None else None
+        vm.csv_ip_address = plan.csv_address
+        vm.set_comments()
+
+        # The address was allocated when planning, it is used as given
+        vm.vlan = None
+        vm.csv_ip_address = plan.address
+        vm.build()
+        vm.vlan = resolver.get_by_id(VLAN, plan.vlan_id)
+        vm.pool_prefix = resolver.get_by_id(Prefix, plan.pool_prefix_id)
+        return vm
+
+    def plan(self):
+        """
+        Resolve everything create() would write, without writing anything
+        """
+        self.build()
+        with self.measure('config_context'):
+            try:
+                self.interface = self.__build_interface(self.virtual_machine)
+            except Exception as e:
+                raise Exception("Error while creating interface - {0}".format(e))
+            try:
+                self.services = self.get_config_context().get('prometheus_exporters') or {}
+                if len(self.services) > 0:
+                    self.get_prometheus_env()
+            except Exception as e:
+                raise Exception("Error while creating service - {0}".format(e))
+        return True
+
+    RECONCILE_FIELDS = ['status', 'cluster', 'tenant', 'platform', 'role', 'vcpus', 'memory', 'disk']
+
+    @staticmethod
+    def get_tag_columns(names):
+        """
+        Sort tag names into the CSV columns they come from
+        """
+        columns = dict(datazone=[], env=[], backup=[], backup_offsite=[], extra_tags=[])
+        for name in names:
+            if name.startswith('datazone_'):
+                columns['datazone'].append(name)
+            elif name.startswith('env_'):
+                columns['env'].append(name)
+            elif name.startswith('backup') and 'offsite' in name:
+                columns['backup_offsite'].append(name)
+            elif name.startswith('backup'):
+                columns['backup'].append(name)
+            elif name not in VM.DEFAULT_TAGS:
+                columns['extra_tags'].append(name)
+        return columns
+
+    def get_changes(self, vm: VirtualMachine, columns):
+        """
+        Differences between an existing VM and this row, in the given CSV columns only
+
+        `vm` should have its tags and services prefetched. Returns the changed
+        fields, the tags to add and remove and the missing exporter services.
+        """
+        built = self.__build_vm()
+        fields = []
+        for field in self.RECONCILE_FIELDS:
+            if field not in columns:
+                continue
+            attname = VirtualMachine._meta.get_field(field).attname
+            if str(getattr(built, attname)) != str(getattr(vm, attname)):
+                setattr(vm, attname, getattr(built, attname))
+                fields.append(field)
+
+        # Only tags of the given columns are managed, default tags are never removed
+        desired_columns = dict(
+            datazone=[self.datazone.name],
+            env=[self.env.name],
+            backup=[self.backup.name],
+            backup_offsite=[self.backup_offsite.name] if self.backup_offsite is not None else [],
+            extra_tags=[name for name in self.__get_tag_names() if name not in self.DEFAULT_TAGS],
+        )
+        current = {tag.name: tag for tag in vm.tags.all()}
+        current_columns = self.get_tag_columns(current)
+        desired = set(self.DEFAULT_TAGS)
+        managed = set()
+        for column, names in desired_columns.items():
+            if column in columns:
+                desired.update(names)
+                managed.update(current_columns[column])
+        add_tags = self.resolver.get_tags([name for name in desired if name not in current])
+        remove_tags = [current[name] for name in managed if name not in desired]
+
+        # The comments hold the CSV row, they follow the other changes
+        if len(fields) > 0 or len(add_tags) > 0 or len(remove_tags) > 0:
+            if built.comments != vm.comments:
+                vm.comments = built.comments
+                fields.append('comments')
+
+        existing_services = set(service.name for service in vm.services.all())
+        missing_services = [name for name in self.get_config_context().get('prometheus_exporters') or {} if name not in existing_services]
+
+        return fields, add_tags, remove_tags, missing_services
+
+    @classmethod
+    def create_bulk(cls, vms):
+        """
+        Write a batch of built VMs in phases, one bulk statement per model and phase
+        """
+        stats = vms[0].resolver.stats
+        timings = [vm.timings for vm in vms]
+
+        with stats.measure('create_vm', timings):
+            virtual_machines = VirtualMachine.objects.bulk_create([vm.virtual_machine for vm in vms])
+
+        with stats.measure('create_ip_address', timings):
+            for prefix in set(vm.pool_prefix for vm in vms if vm.pool_prefix is not None):
+                vms[0].resolver.ip_pools.mark_pool(prefix)
+            ip_addresses = IPAddress.objects.bulk_create([vm.ip_address for vm in vms])
+
+            for virtual_machine, ip_address in zip(virtual_machines, ip_addresses):
+                virtual_machine.primary_ip4 = ip_address
+            VirtualMachine.objects.bulk_update(virtual_machines, ['primary_ip4'])
+
+        with stats.measure('create_tags', timings):
+            # Missing tags for the whole batch are created at once, then every (VM, tag) row in one insert
+            vms[0].resolver.get_tags([name for vm in vms for name in vm.__get_tag_names()])
+            tagged_item = VirtualMachine.tags.through
+            content_type = vms[0].resolver.get_content_type(VirtualMachine)
+            tagged_item.objects.bulk_create([
+                tagged_item(content_type=content_type, object_id=vm.virtual_machine.pk, tag=tag)
+                for vm in vms
+                for tag in vm.__resolve_tags()
+            ])
+            for vm in vms:
+                vm.set_tags(vm.virtual_machine.tags)
+
+        with stats.measure('config_context', timings):
+            # Rendered once per profile, interfaces and services read it from the run cache
+            for vm in vms:
+                vm.get_config_context()
+
+        with stats.measure('create_interface', timings):
+            try:
+                interfaces = VMInterface.objects.bulk_create([vm.__build_interface(vm.virtual_machine) for vm in vms])
+                for vm, interface in zip(vms, interfaces):
+                    vm.__assign_ip_address(interface)
+                IPAddress.objects.bulk_update(ip_addresses, ['assigned_object_type', 'assigned_object_id'])
+            except Exception as e:
+                raise Exception("Error while creating interface - {0}".format(e))
+
+        with stats.measure('create_service', timings):
+            try:
+                services = ServiceBuffer(vms[0].resolver)
+                for vm in vms:
+                    services.add(vm, vm.virtual_machine)
+                services = services.flush()
+            except Exception as e:
+                raise Exception("Error while creating service - {0}".format(e))
+
+        with stats.measure('changelog', timings):
+            changelog = ChangeLogBuffer(vms[0].resolver.request)
+            changelog.add(virtual_machines, ObjectChangeActionChoices.ACTION_CREATE)
+            changelog.add(ip_addresses, ObjectChangeActionChoices.ACTION_CREATE)
+            changelog.add(interfaces, ObjectChangeActionChoices.ACTION_CREATE)
+            changelog.add(services, ObjectChangeActionChoices.ACTION_CREATE)
+            changelog.flush()
+        return True
+
+
+class RowSchema:
+    """
+    Typed checks of the CSV columns, run over the whole batch before anything is written
+
+    Values are parsed column by column and every error in the file is reported at once.
+    Empty cells count as not given.
+    """
+
+    INTEGER_RANGES = {
+        'vcpus': (1, 256),
+        'memory': (128, 4194304),
+        'disk': (1, 65536),
+        'vlan': (1, 4094),
+    }
+    REQUIRED = ['vcpus', 'memory', 'disk']
+    CHOICES = {
+        'status': tuple(VirtualMachineStatusChoices.values()),
+        'prom_alert_type': VM.PROM_ALERT_TYPES,
+    }
+    HOSTNAME = re.compile(r'^[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?$', re.IGNORECASE)
+
+    def __init__(self, defaults=None, reconcile=False):
+        # Script defaults fill in for missing cells, e.g. default_vlan
+        self.defaults = defaults or {}
+        # Rows of existing VMs only give what changes, new VMs are checked with get_missing
+        self.reconcile = reconcile
+
+    @staticmethod
+    def get_value(row, column):
+        value = row.get(column)
+        if isinstance(value, str):
+            value = value.strip()
+        return None if value == '' else value
+
+    def parse_integer(self, column, value):
+        minimum, maximum = self.INTEGER_RANGES[column]
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("`{0}` is not a number".format(value))
+        if number < minimum or number > maximum:
+            raise ValueError("{0} is outside {1}-{2}".format(number, minimum, maximum))
+        return number
+
+    def parse_ip_address(self, column, value):
+        try:
+            if '/' not in str(value):
+                raise ValueError()
+            return str(netaddr.IPNetwork(value))
+        except (netaddr.AddrFormatError, TypeError, ValueError):
+            raise ValueError("`{0}` is not an address with prefix length, e.g. 10.0.0.10/24".format(value))
+
+    def parse_hostname(self, column, value):
+        if not self.HOSTNAME.match(value):
+            raise ValueError("`{0}` is not a valid hostname".format(value))
+        return value
+
+    def parse_choice(self, column, value):
+        if value not in self.CHOICES[column]:
+            raise ValueError("`{0}` is not one of {1}".format(value, ", ".join(self.CHOICES[column])))
+        return value
+
+    def get_parsers(self):
+        parsers = {column: self.parse_integer for column in self.INTEGER_RANGES}
+        parsers.update({column: self.parse_choice for column in self.CHOICES})
+        parsers['ip_address'] = self.parse_ip_address
+        parsers['hostname'] = self.parse_hostname
+        return parsers
+
+    def validate(self, rows):
+        """
+        Returns a list of errors in the batch, empty if every row parses
+        """
+        parsers = self.get_parsers()
+        columns = {column: [] for column in parsers}
+        for row in rows:
+            for column in parsers:
+                columns[column].append(self.get_value(row, column))
+
+        errors = []
+        for column, parse in parsers.items():
+            for line, value in enumerate(columns[column], start=1):
+                if value is None:
+                    if column in self.REQUIRED and self.defaults.get(column) is None and not self.reconcile:
+                        errors.append((line, "CSV line {0}, `{1}` is required".format(line, column)))
+                    continue
+                try:
+                    parse(column, value)
+                except ValueError as e:
+                    errors.append((line, "CSV line {0}, `{1}` {2}".format(line, column, e)))
+
+        # Addresses are allocated from the VLAN when none is given
+        default_vlan = self.defaults.get('vlan')
+        for line, (address, vlan) in enumerate(zip(columns['ip_address'], columns['vlan']), start=1):
+            if address is None and vlan is None and default_vlan is None and not self.reconcile:
+                errors.append((line, "CSV line {0}, `ip_address` is required when no `vlan` is given".format(line)))
+
+        return [error for line, error in sorted(errors, key=lambda error: error[0])]
+
+    def get_missing(self, vm_kwargs):
+        """
+        Columns a new VM needs that the row, with the script defaults, leaves out
+        """
+        missing = [column for column in self.REQUIRED if vm_kwargs.get(column) is None]
+        if vm_kwargs.get('ip_address') is None and vm_kwargs.get('vlan') is None:
+            missing.append('ip_address or vlan')
+        return missing
+
+    def clean(self, row):
+        """
+        Copy of a validated row with empty cells as None and numbers as int
+        """
+        cleaned = {column: self.get_value(row, column) for column in row}
+        for column in self.INTEGER_RANGES:
+            if cleaned.get(column) is not None:
+                cleaned[column] = int(cleaned[column])
+        return cleaned
+
 
 class BulkDeployVM(Script):
     """
@@ -514,32 +1861,79 @@ class BulkDeployVM(Script):
     Param: disk             - Disk2 size
     Param: hostname         - VM hostname (Optional if 'role' is set)
     Param: role             - VM Device role
-    Param: ip_address       - VM IP address
+    Param: ip_address       - VM IP address (Optional if 'vlan' is set)
 
     ** Optional Params **
-    Param: status       - VM status (default 'staged')
+    Param: status       - VM status, e.g. 'staged' or 'planned' (default 'staged')
     Param: tenant       - Netbox tenant (default slug:'patientsky-hosting')
-    Param: datazone     - Adds 'datazone_x' tag (default 'rr')
+    Param: datazone     - Adds 'datazone_x' tag (default 'rr', 'capacity' for the least loaded)
     Param: extra_tags   - Adds extra tags to VM
+    Param: vlan         - VLAN ID in the cluster's site, the IP address is assigned from its prefix if none given
     """
 
     DEFAULT_CSV_FIELDS = "vcpus,memory,disk,ip_address,extra_tags"
+    CHUNK_SIZE = 500
+    MAX_ERRORS = 100
+    chunk_queue_class = ChunkJobQueue
     datazone_rr: bool = True
 
     class Meta:
         name = "Bulk deploy new VMs"
         description = "Deploy new virtual machines from existing platforms"
-        fields = ['vms', 'default_status', 'default_tenant', 'default_datazone', 'default_backup', 'default_backup_offsite', 'default_role', 'default_prom_alert_type']
-        field_order = ['vms', 'default_prom_alert_type', 'default_status', 'default_tenant', 'default_datazone', 'default_backup', 'default_backup_offsite', 'default_role']
+        fields = ['vms', 'vms_file', 'mode', 'commit_every', 'workers', 'background', 'default_status', 'default_tenant', 'default_datazone', 'placement_clusters', 'default_backup', 'default_backup_offsite', 'default_role', 'default_vlan', 'default_prom_alert_type']
+        field_order = ['vms', 'vms_file', 'mode', 'commit_every', 'workers', 'background', 'default_prom_alert_type', 'default_status', 'default_tenant', 'default_datazone', 'placement_clusters', 'default_backup', 'default_backup_offsite', 'default_role', 'default_vlan']
         commit_default = False
 
     vms = TextVar(
         label="Import CSV",
-        description="CSV data",
-        required=True,
+        description="CSV data, not used if a file is uploaded",
+        required=False,
         default=DEFAULT_CSV_FIELDS
     )
 
+    vms_file = FileVar(
+        label="Import file",
+        description="CSV (`.csv`) or newline delimited JSON (`.ndjson`, `.jsonl`), optionally gzipped (`.gz`)",
+        required=False,
+    )
+
+    mode = ChoiceVar(
+        label="Mode",
+        description="`row` saves each VM on its own, `bulk` writes the batch in phases with bulk statements, `plan` only shows what would be created, `parallel` writes each site and cluster on its own worker, `reconcile` only writes what changed on existing VMs",
+        default="row",
+        required=False,
+        choices=(
+            ('row', 'Row by row'),
+            ('bulk', 'Bulk'),
+            ('plan', 'Plan only (read only, nothing is written)'),
+            ('parallel', 'Parallel per site and cluster (commit only)'),
+            ('reconcile', 'Reconcile (update existing VMs by hostname, create new ones)'),
+        )
+    )
+
+    commit_every = IntegerVar(
+        label="Commit every",
+        description="Rows per chunk that commit on their own as soon as they are written. Empty writes everything in the script transaction",
+        min_value=1,
+        required=False,
+    )
+
+    workers = IntegerVar(
+        label="Workers",
+        description="Parallel mode only, each worker has its own database connection",
+        default=4,
+        min_value=1,
+        max_value=16,
+        required=False,
+    )
+
+    background = BooleanVar(
+        label="Background chunk jobs",
+        description="Split the import into one background job per chunk, progress is written to a job of its own",
+        default=False,
+        required=False,
+    )
+
     default_status = ChoiceVar(
         label="Default Status",
         description="Default VM `status`",
@@ -565,6 +1959,7 @@ class BulkDeployVM(Script):
         required=False,
         choices=(
             ('rr', 'Round robin (1,2)'),
+            ('capacity', 'Least loaded (1,2)'),
             ('1', '1'),
             ('2', '2')
         )
@@ -575,12 +1970,7 @@ class BulkDeployVM(Script):
         description="Default CSV field `prom_alert_type` if none given",
         default="24-7-devops",
         required=False,
-        choices=(
-            ('24-7-devops', '24-7-devops'),
-            ('37-5-devops', '37-5-devops'),
-            ('24-7-voip', '24-7-voip'),
-            ('37-5-voip', '37-5-voip'),
-        )
+        choices=tuple((alert_type, alert_type) for alert_type in VM.PROM_ALERT_TYPES)
     )
 
     default_cluster = ObjectVar(
@@ -590,6 +1980,13 @@ class BulkDeployVM(Script):
         required=False,
     )
 
+    placement_clusters = MultiObjectVar(
+        model=Cluster,
+        label="Placement Clusters",
+        description="Rows without `cluster` are placed on the least loaded of these, replaces the default cluster",
+        required=False,
+    )
+
     default_env = ObjectVar(
         model=Tag,
         label="Default Environment",
@@ -642,6 +2039,14 @@ class BulkDeployVM(Script):
         )
     )
 
+    default_vlan = IntegerVar(
+        label="Default VLAN",
+        description="Default CSV field `vlan` for rows without `vlan` and `ip_address`, VLAN ID in the cluster's site",
+        min_value=1,
+        max_value=4094,
+        required=False,
+    )
+
     def get_vm_data(self):
         return self.vm_data
 
@@ -652,7 +2057,65 @@ class BulkDeployVM(Script):
         return self.csv_raw_data
 
     def set(self, data):
-        self.set_csv_data(data['vms'].splitlines())
+        self.csv_raw_data = self.read_rows(data)
+
+    @staticmethod
+    def normalize_json_row(row):
+        # Give JSON rows the same shape as CSV rows
+        normalized = {}
+        for key, value in row.items():
+            if isinstance(value, list):
+                value = ",".join(str(item) for item in value)
+            elif value is not None and not isinstance(value, str):
+                value = str(value)
+            normalized[key] = value
+        return normalized
+
+    def read_rows(self, data):
+        """
+        Lazily parse rows from the uploaded file, or from the CSV text if no file is given
+        """
+        if data.get('vms_rows') is not None:
+            # Rows handed to a background chunk job
+            yield from data['vms_rows']
+            return
+
+        upload = data.get('vms_file')
+        if upload is None:
+            yield from csv.DictReader(io.StringIO(data['vms']), delimiter=',')
+            return
+
+        name = upload.name.lower()
+        stream = getattr(upload, 'file', upload)
+        stream.seek(0)
+        if name.endswith('.gz'):
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+            name = name[:-len('.gz')]
+
+        text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        try:
+            if name.endswith(('.ndjson', '.jsonl')):
+                for row in text:
+                    if row.strip() != "":
+                        yield self.normalize_json_row(json.loads(row))
+            else:
+                yield from csv.DictReader(text, delimiter=',')
+        finally:
+            # Keep the upload open, it is read once for the preflight and once for the import
+            text.detach()
+
+    def get_chunks(self, rows, size):
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+    def get_output(self, data):
+        if data.get('vms_file') is None:
+            return data['vms']
+        return "Imported `{0}`".format(data['vms_file'].name)
 
     def get_datazone(self, datazone):
         if datazone == 'rr':
@@ -660,46 +2123,655 @@ class BulkDeployVM(Script):
             self.datazone_rr = not self.datazone_rr
         return datazone
 
+    def get_site_envs(self, data):
+        """
+        Clusters and env of every row with the script defaults, rows left to placement may use any placement cluster
+        """
+        placement_clusters = list(data.get('placement_clusters') or [])
+        for line, raw_vm in enumerate(self.get_csv_raw_data(), start=1):
+            row = self.schema.clean(raw_vm)
+            if row.get('cluster') is not None:
+                clusters = [row.get('cluster')]
+            elif len(placement_clusters) > 0:
+                clusters = placement_clusters
+            elif data.get('default_cluster') is not None:
+                clusters = [data.get('default_cluster')]
+            else:
+                clusters = []
+            yield line, clusters, row.get('env') if row.get('env') is not None else data.get('default_env')
+
+    def get_vm_kwargs(self, raw_vm, data):
+        return dict(
+            status=raw_vm.get('status') if raw_vm.get('status') is not None else data['default_status'],
+            tenant=raw_vm.get('tenant') if raw_vm.get('tenant') is not None else data['default_tenant'],
+            datazone=raw_vm.get('datazone') if raw_vm.get('datazone') is not None else self.get_datazone(data['default_datazone']),
+            cluster=raw_vm.get('cluster') if raw_vm.get('cluster') is not None else (None if data.get('placement_clusters') else data['default_cluster']),
+            prom_alert_type=raw_vm.get('prom_alert_type') if raw_vm.get('prom_alert_type') is not None else data['default_prom_alert_type'],
+            env=raw_vm.get('env') if raw_vm.get('env') is not None else data['default_env'],
+            platform=raw_vm.get('platform') if raw_vm.get('platform') is not None else data['default_platform'],
+            role=raw_vm.get('role') if raw_vm.get('role') is not None else data['default_role'],
+            backup=raw_vm.get('backup') if raw_vm.get('backup') is not None else data['default_backup'],
+            backup_offsite=raw_vm.get('backup_offsite') if raw_vm.get('backup_offsite') is not None else data['default_backup_offsite'],
+            vcpus=raw_vm.get('vcpus'),
+            memory=raw_vm.get('memory'),
+            disk=raw_vm.get('disk'),
+            hostname=raw_vm.get('hostname'),
+            ip_address=raw_vm.get('ip_address'),
+            extra_tags=raw_vm.get('extra_tags'),
+            # Rows with an address of their own never fall back to the default VLAN
+            vlan=raw_vm.get('vlan') if raw_vm.get('vlan') not in (None, '') else (data.get('default_vlan') if raw_vm.get('ip_address') is None else None),
+        )
+
     def run(self, data, commit):
+        if data.get('parent_job') is None:
+            return self.run_import(data, commit)
 
-        # Set data from raw csv
+        # A chunk job reports to the progress job however it ends
+        self.done = 0
+        try:
+            return self.run_import(data, commit)
+        finally:
+            rows = len(data['vms_rows'])
+            self.update_progress(data['parent_job'], rows_done=rows, rows_failed=rows - self.done, chunks_done=1)
+
+    def run_import(self, data, commit):
+        mode = data.get('mode') or 'row'
+        if mode == 'parallel' and not commit:
+            # Workers commit on their own connections, that can not be rolled back
+            self.log_warning("Parallel mode always commits, running in bulk mode instead")
+            mode = 'bulk'
+        resolver = VMResolver(read_only=mode == 'plan', request=getattr(self, 'request', None), locking=commit)
+        self.stats = resolver.stats
+
+        # Reject a malformed file before any lookup, every error is reported in one pass
+        self.schema = RowSchema(defaults=dict(vlan=data.get('default_vlan')), reconcile=mode == 'reconcile')
+        self.set(data)
+        with resolver.stats.measure('validate'):
+            errors = self.schema.validate(self.get_csv_raw_data())
+        if len(errors) > 0:
+            for error in errors[:self.MAX_ERRORS]:
+                self.log_failure(error)
+            if len(errors) > self.MAX_ERRORS:
+                self.log_failure("... and {0} more errors".format(len(errors) - self.MAX_ERRORS))
+            self.log_failure("Found {0} errors in CSV, no VMs were created".format(len(errors)))
+            return self.get_output(data)
+
+        # Report every conflict before anything is written, this pass only keeps addresses and hostnames
         self.set(data)
-        line = 1
-        for raw_vm in self.get_csv_raw_data():
+        with resolver.stats.measure('preflight'):
+            conflicts = resolver.preflight(map(self.schema.clean, self.get_csv_raw_data()), reconcile=mode == 'reconcile')
+        # Exporter services need a prometheus env for every site and env the batch uses
+        self.set(data)
+        with resolver.stats.measure('preflight'):
+            conflicts += resolver.check_prometheus_envs(self.get_site_envs(data))
+        if len(conflicts) > 0:
+            for conflict in conflicts:
+                self.log_failure(conflict)
+            self.log_failure("Found {0} conflicts in CSV, no VMs were created".format(len(conflicts)))
+            return self.get_output(data)
+
+        if data.get('background') and mode != 'plan':
+            return self.run_background(data, commit, resolver.rows)
+
+        self.plan_output = [
+            "| Line | Status | Hostname | IP address | Cluster | Env | Datazone | Tags | Interface | Services | Result |",
+            "|---|---|---|---|---|---|---|---|---|---|---|",
+        ]
+
+        # Set data from raw csv, rows are read and processed one chunk at a time
+        self.set(data)
+        line = 0
+        self.done = 0
+        # Chunks only commit on their own when asked to, by default the script commits or rolls back as a whole
+        per_chunk = commit and mode != 'plan' and data.get('commit_every') is not None
+        for chunk in self.get_chunks(self.get_csv_raw_data(), data.get('commit_every') or self.CHUNK_SIZE):
+            rows = []
+            for raw_vm in chunk:
+                line += 1
+                rows.append((line, raw_vm, self.get_vm_kwargs(self.schema.clean(raw_vm), data)))
+
             try:
-                vm = VM(
-                    status=raw_vm.get('status') if raw_vm.get('status') is not None else data['default_status'],
-                    tenant=raw_vm.get('tenant') if raw_vm.get('tenant') is not None else data['default_tenant'],
-                    datazone=raw_vm.get('datazone') if raw_vm.get('datazone') is not None else self.get_datazone(data['default_datazone']),
-                    cluster=raw_vm.get('cluster') if raw_vm.get('cluster') is not None else data['default_cluster'],
-                    prom_alert_type=raw_vm.get('prom_alert_type') if raw_vm.get('prom_alert_type') is not None else data['default_prom_alert_type'],
-                    env=raw_vm.get('env') if raw_vm.get('env') is not None else data['default_env'],
-                    platform=raw_vm.get('platform') if raw_vm.get('platform') is not None else data['default_platform'],
-                    role=raw_vm.get('role') if raw_vm.get('role') is not None else data['default_role'],
-                    backup=raw_vm.get('backup') if raw_vm.get('backup') is not None else data['default_backup'],
-                    backup_offsite=raw_vm.get('backup_offsite') if raw_vm.get('backup_offsite') is not None else data['default_backup_offsite'],
-                    vcpus=raw_vm.get('vcpus'),
-                    memory=raw_vm.get('memory'),
-                    disk=raw_vm.get('disk'),
-                    hostname=raw_vm.get('hostname'),
-                    ip_address=raw_vm.get('ip_address'),
-                    extra_tags=raw_vm.get('extra_tags')
-                )
-                vm.create()
-                self.log_success(
-                    "{} `{}` for `{}`, `{}`, in cluster `{}`, env `{}`, datazone `{}`, backup `{}`".
-                    format(
-                        vm.status.capitalize(),
-                        vm.hostname,
-                        vm.tenant,
-                        vm.ip_address.address,
-                        vm.cluster,
-                        str(vm.env.name).split('_')[1],
-                        vm.datazone,
-                        vm.backup,
-                    )
+                if per_chunk:
+                    # Inside NetBox's script transaction a chunk would only be a savepoint holding
+                    # its locks until the script ends, on a connection of its own it commits at once
+                    self.done += self.on_own_connection(lambda: self.run_chunk(rows, resolver, mode, data))
+                else:
+                    # Chunks only bound memory here, each is a savepoint of the script transaction
+                    with resolver.atomic():
+                        self.done += self.run_chunk(rows, resolver, mode, data)
+            except Exception as e:
+                self.log_failure("Error while committing CSV lines {0}-{1}, no VMs in these lines were created \n`{2}`".format(rows[0][0], rows[-1][0], e))
+
+        if mode == 'plan':
+            self.log_info("Planned {0} of {1} VMs, nothing was written".format(self.done, line))
+            return "\n".join(self.plan_output) + "\n\n" + resolver.stats.get_table()
+        return self.get_output(data) + "\n\n" + resolver.stats.get_table()
+
+    def run_chunk(self, rows, resolver, mode, data):
+        """
+        Place, load and write one chunk, returns the number of rows done
+        """
+        existing = {}
+        if mode == 'reconcile':
+            # Existing VMs keep what the row leaves out and are never placed again
+            existing = self.get_existing(rows)
+            for line, raw_vm, vm_kwargs in rows:
+                if vm_kwargs.get('hostname') in existing:
+                    self.keep_current(vm_kwargs, self.get_columns(raw_vm), existing[vm_kwargs['hostname']])
+
+        # Placement comes first, hostname prefixes depend on the cluster's site
+        with resolver.stats.measure('placement'):
+            resolver.place_rows([vm_kwargs for line, raw_vm, vm_kwargs in rows if vm_kwargs.get('hostname') not in existing], data.get('placement_clusters'))
+        for line, raw_vm, vm_kwargs in rows:
+            if vm_kwargs['datazone'] == 'capacity':
+                # Cluster unknown, the row fails on it anyway
+                vm_kwargs['datazone'] = self.get_datazone('rr')
+
+        # Load all reference data the chunk points at once
+        with resolver.stats.measure('preload'):
+            resolver.preload_rows([vm_kwargs for line, raw_vm, vm_kwargs in rows])
+
+        if mode == 'plan':
+            return self.run_plan(rows, resolver)
+        elif mode == 'parallel':
+            return self.run_parallel(rows, resolver, data.get('workers') or 1)
+
+        with resolver.atomic():
+            if mode == 'bulk':
+                return self.run_bulk(rows, resolver)
+            elif mode == 'reconcile':
+                return self.run_reconcile(rows, resolver, existing)
+            return self.run_rows(rows, resolver)
+
+    @staticmethod
+    def on_own_connection(func):
+        """
+        Run func on a connection of its own, it commits at once whatever the script transaction does
+        """
+        def run():
+            try:
+                with transaction.atomic():
+                    return func()
+            finally:
+                connection.close()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(run).result()
+
+    def get_parent_job(self, rows_total, chunks_total):
+        """
+        Job of its own for the progress of a background import
+
+        NetBox overwrites the data of the script's own job with the script output when it returns,
+        before any chunk job runs. Progress is kept in a separate job the chunk jobs get by pk.
+        """
+        def create():
+            job = JobResult.objects.create(
+                name=self.full_name,
+                obj_type=ContentType.objects.get(app_label='extras', model='script'),
+                user=self.request.user if getattr(self, 'request', None) is not None else None,
+                status=JobResultStatusChoices.STATUS_RUNNING,
+                job_id=uuid.uuid4(),
+                data=dict(progress=dict(
+                    rows_total=rows_total,
+                    chunks_total=chunks_total,
+                    rows_done=0,
+                    rows_failed=0,
+                    chunks_done=0,
+                    started=time.time(),
+                )),
+            )
+            return job.pk
+        return self.on_own_connection(create)
+
+    def update_progress(self, parent_job, rows_done, rows_failed, chunks_done):
+        def update():
+            job = JobResult.objects.select_for_update().get(pk=parent_job)
+            data = job.data or {}
+            progress = data.setdefault('progress', {})
+            progress['rows_done'] = progress.get('rows_done', 0) + rows_done
+            progress['rows_failed'] = progress.get('rows_failed', 0) + rows_failed
+            progress['chunks_done'] = progress.get('chunks_done', 0) + chunks_done
+
+            elapsed = max(time.time() - progress.get('started', time.time()), 0.001)
+            progress['rate'] = round(progress['rows_done'] / elapsed, 2)
+            if progress.get('rows_total') is not None and progress['rate'] > 0:
+                progress['eta'] = round((progress['rows_total'] - progress['rows_done']) / progress['rate'], 1)
+
+            if progress['chunks_done'] >= progress.get('chunks_total', 0):
+                job.set_status(JobResultStatusChoices.STATUS_COMPLETED)
+                progress['summary'] = "Imported {0} of {1} rows in {2} chunks, {3} failed, {4:.1f} s".format(
+                    progress['rows_done'] - progress['rows_failed'],
+                    progress.get('rows_total'),
+                    progress['chunks_done'],
+                    progress['rows_failed'],
+                    elapsed,
                 )
-                line += 1
+            job.data = data
+            job.save()
+            return progress
+        return self.on_own_connection(update)
+
+    def run_background(self, data, commit, rows_total):
+        """
+        Queue one job per chunk, every chunk job adds its figures to the progress job
+        """
+        size = data.get('commit_every') or self.CHUNK_SIZE
+        parent_job = self.get_parent_job(rows_total, (rows_total + size - 1) // size)
+        queue = self.chunk_queue_class()
+
+        self.set(data)
+        chunks = 0
+        for chunk in self.get_chunks(self.get_csv_raw_data(), size):
+            # Uploads can not be handed to a job, the chunk rows are
+            chunk_data = dict(data, vms='', vms_file=None, vms_rows=chunk, background=False, parent_job=parent_job)
+            queue.enqueue(self, chunk_data, commit)
+            chunks += 1
+
+        self.log_info("Queued {0} rows in {1} chunk jobs, progress is written to job {2}".format(rows_total, chunks, parent_job))
+        return self.get_output(data)
+
+    def log_created(self, vm):
+        self.log_success(
+            "{} `{}` for `{}`, `{}`, in cluster `{}`, env `{}`, datazone `{}`, backup `{}` \n`{}`".
+            format(
+                vm.status.capitalize(),
+                vm.hostname,
+                vm.tenant,
+                vm.ip_address.address,
+                vm.cluster,
+                str(vm.env.name).split('_')[1],
+                vm.datazone,
+                vm.backup,
+                vm.get_timings(),
+            )
+        )
+
+    def log_row_failure(self, line, e, raw_vm):
+        self.log_failure("Error in CSV line {0}, while creating VM \n`{1}` data \n`{2}`".format(line, e, raw_vm))
+
+    def run_rows(self, rows, resolver):
+        created = 0
+        for line, raw_vm, vm_kwargs in rows:
+            try:
+                # A failing row only rolls back its own savepoint
+                with resolver.atomic():
+                    vm = VM(resolver=resolver, **vm_kwargs)
+                    vm.create()
+                self.log_created(vm)
+                created += 1
+            except Exception as e:
+                self.log_row_failure(line, e, raw_vm)
+        return created
+
+    def get_plans(self, rows, resolver):
+        """
+        Plan every row, rows that fail here are logged and left out
+
+        The interface prefix and config context are resolved per row as well, a row that
+        can not get its interface or services fails alone instead of rolling back its chunk
+        """
+        plans = []
+        for line, raw_vm, vm_kwargs in rows:
+            try:
+                vm = VM(resolver=resolver, **vm_kwargs)
+                vm.plan()
+                plans.append(vm.to_plan(line))
+            except Exception as e:
+                self.log_row_failure(line, e, raw_vm)
+        return plans
+
+    def run_bulk(self, rows, resolver):
+        if self.schema.reconcile:
+            # The schema let reconcile rows leave out what existing VMs keep, new VMs need it
+            new_rows = []
+            for line, raw_vm, vm_kwargs in rows:
+                missing = self.schema.get_missing(vm_kwargs)
+                if len(missing) > 0:
+                    self.log_row_failure(line, "New VM, `{0}` is required".format("`, `".join(missing)), raw_vm)
+                else:
+                    new_rows.append((line, raw_vm, vm_kwargs))
+            rows = new_rows
+
+        plans = self.get_plans(rows, resolver)
+        if len(plans) == 0:
+            return 0
+
+        vms = []
+        try:
+            with resolver.atomic():
+                # ORM objects only exist while the batch is written
+                vms = [VM.from_plan(plan, resolver) for plan in plans]
+                VM.create_bulk(vms)
+        except Exception as e:
+            self.log_failure("Error while writing batch of {0} VMs, no VMs were created \n`{1}`".format(len(plans), e))
+            return 0
+
+        for vm in vms:
+            self.log_created(vm)
+        return len(vms)
+
+    def run_plan(self, rows, resolver):
+        """
+        Resolve every row read only and add it to the plan table
+        """
+        planned = 0
+        for line, raw_vm, vm_kwargs in rows:
+            try:
+                vm = VM(resolver=resolver, **vm_kwargs)
+                vm.plan()
+                self.plan_output.append("| {0} | {1} | {2} | {3} | {4} | {5} | {6} | {7} | {8} | {9} | OK |".format(
+                    line,
+                    vm.status,
+                    vm.hostname,
+                    vm.ip_address.address,
+                    vm.cluster,
+                    str(vm.env.name).split('_')[1],
+                    vm.datazone,
+                    ", ".join(vm.get_tag_names()),
+                    "{0} ({1})".format(vm.interface.name, vm.interface.untagged_vlan) if vm.interface.untagged_vlan is not None else vm.interface.name,
+                    ", ".join(vm.services),
+                ))
+                planned += 1
             except Exception as e:
-                self.log_failure("Error in CSV line {0}, while creating VM \n`{1}` data \n`{2}`".format(line, e, raw_vm))
-        return data['vms']
+                self.log_row_failure(line, e, raw_vm)
+                self.plan_output.append("| {0} | | {1} | {2} | | | | | | | {3} |".format(
+                    line,
+                    vm_kwargs.get('hostname') or "",
+                    vm_kwargs.get('ip_address') or "",
+                    str(e).replace("|", "\\|").replace("\n", " "),
+                ))
+        return planned
+
+    def prepare_partitions(self, plans, resolver):
+        """
+        Commit what the partitions share, workers can not see uncommitted rows of each other
+        """
+        try:
+            with resolver.atomic():
+                resolver.get_tags([name for plan in plans for name in plan.get_tag_names()])
+                for pool_prefix_id in set(plan.pool_prefix_id for plan in plans if plan.pool_prefix_id is not None):
+                    resolver.ip_pools.mark_pool(resolver.get_by_id(Prefix, pool_prefix_id))
+        finally:
+            connection.close()
+
+    def run_partition(self, plans, resolver):
+        """
+        Write one partition on the worker's own database connection
+        """
+        vms = []
+        try:
+            with resolver.atomic():
+                vms = [VM.from_plan(plan, resolver) for plan in plans]
+                VM.create_bulk(vms)
+        except Exception as e:
+            return vms, e
+        finally:
+            connection.close()
+        return vms, None
+
+    def run_parallel(self, rows, resolver, workers):
+        # Hostnames and addresses are allocated centrally before rows are split up
+        plans = self.get_plans(rows, resolver)
+        if len(plans) == 0:
+            return 0
+
+        # Rows of different sites and clusters share no prefixes, VLANs or hostname prefixes
+        partitions = defaultdict(list)
+        for plan in plans:
+            partitions[(plan.site_id, plan.cluster_id)].append(plan)
+        partitions = list(partitions.values())
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            executor.submit(self.prepare_partitions, plans, resolver).result()
+            results = list(executor.map(lambda partition: self.run_partition(partition, resolver), partitions))
+
+        # Merge the partitions back into one log in CSV order
+        raw_vms = {line: raw_vm for line, raw_vm, vm_kwargs in rows}
+        entries = []
+        for partition, (vms, error) in zip(partitions, results):
+            for i, plan in enumerate(partition):
+                entries.append((plan.line, vms[i] if error is None else None, error))
+
+        created = 0
+        for line, vm, error in sorted(entries, key=lambda entry: entry[0]):
+            if error is None:
+                self.log_created(vm)
+                created += 1
+            else:
+                self.log_row_failure(line, "Partition was rolled back - {0}".format(error), raw_vms[line])
+        return created
+
+    def get_existing(self, rows):
+        hostnames = [vm_kwargs.get('hostname') for line, raw_vm, vm_kwargs in rows if vm_kwargs.get('hostname') is not None]
+        if len(hostnames) == 0:
+            return {}
+        return {
+            vm.name: vm for vm in VirtualMachine.objects.filter(
+                name__in=hostnames
+            ).select_related(
+                'cluster__site', 'tenant', 'platform', 'role', 'primary_ip4'
+            ).prefetch_related(
+                'tags', 'services'
+            )
+        }
+
+    def get_columns(self, raw_vm):
+        """
+        CSV columns the row gives a value for, round robin and placement do not count as a datazone
+        """
+        columns = set(column for column, value in self.schema.clean(raw_vm).items() if value is not None)
+        if self.schema.get_value(raw_vm, 'datazone') in ('rr', 'capacity'):
+            columns.discard('datazone')
+        return columns
+
+    def keep_current(self, vm_kwargs, columns, current: VirtualMachine):
+        """
+        Fill what the row leaves out from the existing VM, so defaults never overwrite it
+        """
+        tags = VM.get_tag_columns([tag.name for tag in current.tags.all()])
+        values = dict(
+            status=current.status,
+            tenant=current.tenant,
+            cluster=current.cluster,
+            platform=current.platform,
+            role=current.role,
+            vcpus=current.vcpus,
+            memory=current.memory,
+            disk=current.disk,
+            ip_address=str(current.primary_ip4.address) if current.primary_ip4 is not None else None,
+            prom_alert_type=ExportVM.get_prom_alert_type(current),
+            datazone=tags['datazone'][0].split('datazone_')[1] if len(tags['datazone']) > 0 else None,
+            env=tags['env'][0].split('env_')[1] if len(tags['env']) > 0 else None,
+            backup=tags['backup'][0] if len(tags['backup']) > 0 else None,
+            backup_offsite=tags['backup_offsite'][0] if len(tags['backup_offsite']) > 0 else None,
+            extra_tags=",".join(tags['extra_tags']) if len(tags['extra_tags']) > 0 else None,
+        )
+        for column, value in values.items():
+            if column not in columns and value is not None:
+                vm_kwargs[column] = value
+        return vm_kwargs
+
+    def run_reconcile(self, rows, resolver, existing):
+        """
+        Update existing VMs by hostname with only what changed, new hostnames are created in bulk
+        """
+        done = self.run_bulk([row for row in rows if row[2].get('hostname') not in existing], resolver)
+
+        changed_vms = []
+        changed_fields = set()
+        add_tags = []
+        remove_tags = Q()
+        updated_tags = set()
+        # Missing services of the whole chunk are written like bulk mode does, one insert per table
+        services = ServiceBuffer(resolver)
+        for line, raw_vm, vm_kwargs in rows:
+            if vm_kwargs.get('hostname') not in existing:
+                continue
+            try:
+                current = existing[vm_kwargs.get('hostname')]
+                vm = VM(resolver=resolver, **vm_kwargs)
+                fields, add, remove, missing_services = vm.get_changes(current, self.get_columns(raw_vm))
+                if current.primary_ip4 is not None and vm.csv_ip_address is not None and str(current.primary_ip4.address) != vm.csv_ip_address:
+                    self.log_warning("CSV line {0}, `{1}` keeps its primary IP `{2}`, reconcile does not change addresses".format(line, current, current.primary_ip4.address))
+
+                if len(fields) > 0:
+                    changed_vms.append(current)
+                    changed_fields.update(fields)
+                add_tags += [(current, tag) for tag in add]
+                if len(remove) > 0:
+                    remove_tags |= Q(object_id=current.pk, tag_id__in=[tag.pk for tag in remove])
+                    updated_tags.add(current)
+                if len(missing_services) > 0 and current.primary_ip4 is not None:
+                    services.add(vm, current, names=missing_services)
+
+                changes = fields + ["+tag {0}".format(tag.name) for tag in add] + ["-tag {0}".format(tag.name) for tag in remove] + ["+service {0}".format(name) for name in missing_services]
+                if len(changes) > 0:
+                    self.log_success("Updated `{0}`: {1}".format(current, ", ".join(changes)))
+                else:
+                    self.log_info("Unchanged `{0}`".format(current))
+                done += 1
+            except Exception as e:
+                self.log_row_failure(line, e, raw_vm)
+
+        # Only what changed is written, an unchanged file writes nothing
+        tagged_item = VirtualMachine.tags.through
+        content_type = ContentType.objects.get_for_model(VirtualMachine)
+        if len(changed_vms) > 0:
+            VirtualMachine.objects.bulk_update(changed_vms, sorted(changed_fields))
+        if len(add_tags) > 0:
+            tagged_item.objects.bulk_create([
+                tagged_item(content_type=content_type, object_id=current.pk, tag=tag) for current, tag in add_tags
+            ])
+        if len(remove_tags) > 0:
+            tagged_item.objects.filter(remove_tags, content_type=content_type).delete()
+
+        try:
+            services = services.flush()
+        except Exception as e:
+            raise Exception("Error while creating service - {0}".format(e))
+
+        changelog = ChangeLogBuffer(resolver.request)
+        changelog.add(set(changed_vms) | set(current for current, tag in add_tags) | updated_tags, ObjectChangeActionChoices.ACTION_UPDATE)
+        changelog.add(services, ObjectChangeActionChoices.ACTION_CREATE)
+        changelog.flush()
+        return done
+
+
+class ExportVM(Script):
+    """
+    Export existing VMs as CSV in the columns `BulkDeployVM` imports
+
+    prom_alert_type is read from the CSV kept in the VM comments, VMs without it get the default
+    """
+
+    FIELDS = ['status', 'tenant', 'cluster', 'prom_alert_type', 'datazone', 'env', 'platform', 'role', 'backup', 'backup_offsite', 'vcpus', 'memory', 'disk', 'hostname', 'ip_address', 'extra_tags']
+    CHUNK_SIZE = 500
+
+    class Meta:
+        name = "Export VMs"
+        description = "Export virtual machines as CSV for bulk deploy"
+        field_order = ['site', 'cluster', 'tenant', 'tag']
+        commit_default = False
+
+    site = ObjectVar(
+        model=Site,
+        label="Site",
+        required=False,
+    )
+
+    cluster = ObjectVar(
+        model=Cluster,
+        label="Cluster",
+        required=False,
+    )
+
+    tenant = ObjectVar(
+        model=Tenant,
+        label="Tenant",
+        required=False,
+    )
+
+    tag = ObjectVar(
+        model=Tag,
+        label="Tag",
+        required=False,
+    )
+
+    def get_queryset(self, data):
+        queryset = VirtualMachine.objects.all()
+        if data.get('site') is not None:
+            queryset = queryset.filter(cluster__site=data['site'])
+        if data.get('cluster') is not None:
+            queryset = queryset.filter(cluster=data['cluster'])
+        if data.get('tenant') is not None:
+            queryset = queryset.filter(tenant=data['tenant'])
+        if data.get('tag') is not None:
+            queryset = queryset.filter(tags=data['tag'])
+        return queryset.select_related(
+            'cluster', 'tenant', 'platform', 'role', 'primary_ip4'
+        ).prefetch_related(
+            'tags'
+        ).order_by('pk')
+
+    def iter_vms(self, queryset):
+        """
+        Walk the queryset in pk ordered chunks, two queries per chunk whatever the fleet size
+
+        prefetch_related is ignored by .iterator(), so chunks are fetched by pk instead
+        """
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:self.CHUNK_SIZE])
+            if len(chunk) == 0:
+                return
+            yield from chunk
+            last_pk = chunk[-1].pk
+
+    @staticmethod
+    def get_prom_alert_type(vm):
+        try:
+            comments = list(csv.DictReader(io.StringIO(vm.comments)))
+            return comments[0].get('prom_alert_type') or VM.DEFAULT_PROM_ALERT_TYPE
+        except Exception:
+            return VM.DEFAULT_PROM_ALERT_TYPE
+
+    def get_row(self, vm):
+        row = dict(
+            status=vm.status,
+            tenant=vm.tenant.slug if vm.tenant is not None else "",
+            cluster=vm.cluster.name,
+            prom_alert_type=self.get_prom_alert_type(vm),
+            datazone="",
+            env="",
+            platform=vm.platform.name if vm.platform is not None else "",
+            role=vm.role.name if vm.role is not None else "",
+            backup="",
+            backup_offsite="",
+            vcpus=vm.vcpus if vm.vcpus is not None else "",
+            memory=vm.memory if vm.memory is not None else "",
+            disk=vm.disk if vm.disk is not None else "",
+            hostname=vm.name,
+            ip_address=str(vm.primary_ip4.address) if vm.primary_ip4 is not None else "",
+        )
+
+        columns = VM.get_tag_columns([tag.name for tag in vm.tags.all()])
+        for column in ('datazone', 'env', 'backup', 'backup_offsite'):
+            if len(columns[column]) > 0:
+                row[column] = columns[column][0]
+        row['datazone'] = row['datazone'].split('datazone_')[-1]
+        row['env'] = row['env'].split('env_')[-1]
+        row['extra_tags'] = ",".join(columns['extra_tags'])
+        return row
+
+    def run(self, data, commit):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=self.FIELDS, lineterminator="\n")
+        writer.writeheader()
+
+        exported = 0
+        for vm in self.iter_vms(self.get_queryset(data)):
+            writer.writerow(self.get_row(vm))
+            exported += 1
+
+        self.log_success("Exported {0} VMs".format(exported))
+        return output.getvalue()
@@ -0,0 +1,440 @@
+import csv
+import io
+import random
+import time
+import tracemalloc
+from dcim.choices import SiteStatusChoices
+from dcim.models import Platform, DeviceRole, Site
+from ipam.models import VRF, Prefix, VLAN
+from tenancy.models import Tenant
+from virtualization.models import Cluster, ClusterType
+from extras.choices import LogLevelChoices
+from extras.scripts import Script, ChoiceVar, IntegerVar, BooleanVar
+from extras.models import ConfigContext, Tag
+from django.db import connection, transaction
+from django.utils.text import slugify
+
+from bulk_vm import BulkDeployVM, VM
+
+
+class BenchmarkFixtures:
+    """
+    Seeds a local NetBox with the reference data a synthetic CSV points at
+
+    Everything is created with get_or_create, seeding twice is a no-op
+    """
+
+    SITES = ['cph2', 'osl2', 'sto1', 'cph1']
+    TENANT = 'benchmark'
+    PLATFORM = 'base:v1.0.0-benchmark'
+    BACKUP_TAGS = ['backup_nobackup', 'backup_general_1']
+    EXPORTER_TAG = 'prometheus'
+    CONFIG_CONTEXT = {
+        'interfaces': {
+            'nic0': {'name': 'eth0', 'mtu': 1500, 'mode': 'Access'},
+        },
+        'prometheus_exporters': {
+            'node_exporter': {'ports': [9100], 'protocol': 'tcp', 'metrics_path': '/metrics', 'tags': ['prometheus']},
+        },
+    }
+
+    def __init__(self, sites=2, clusters=2, roles=3):
+        self.site_count = min(sites, len(self.SITES))
+        self.cluster_count = clusters
+        self.role_count = roles
+
+    def get_envs(self, site):
+        # Only envs with a prometheus env translate for the exporter services
+        return [env.split('env_')[1] for env in sorted(VM.PROMETHEUS_DICT[site])][:2]
+
+    def seed(self):
+        self.tenant, _ = Tenant.objects.get_or_create(slug=self.TENANT, defaults=dict(name=self.TENANT))
+        self.platform, _ = Platform.objects.get_or_create(name=self.PLATFORM, defaults=dict(slug=slugify(self.PLATFORM)))
+        VRF.objects.get_or_create(name="global")
+        cluster_type, _ = ClusterType.objects.get_or_create(slug='benchmark', defaults=dict(name='benchmark'))
+
+        self.roles = []
+        for i in range(self.role_count):
+            name = "bench{0}:v1.0.0".format(i)
+            role, _ = DeviceRole.objects.get_or_create(name=name, defaults=dict(slug=slugify(name), vm_role=True))
+            self.roles.append(role)
+
+        tag_names = ['datazone_1', 'datazone_2', self.EXPORTER_TAG] + self.BACKUP_TAGS + VM.DEFAULT_TAGS
+        self.clusters = []
+        for site_index, site_name in enumerate(self.SITES[:self.site_count]):
+            site, _ = Site.objects.get_or_create(name=site_name, defaults=dict(slug=site_name, status=SiteStatusChoices.STATUS_ACTIVE))
+            tag_names += ["env_{0}".format(env) for env in self.get_envs(site_name)]
+            for cluster_index in range(self.cluster_count):
+                cluster, _ = Cluster.objects.get_or_create(
+                    name="{0}-bench{1}".format(site_name, cluster_index),
+                    defaults=dict(type=cluster_type, site=site),
+                )
+                vlan, _ = VLAN.objects.get_or_create(
+                    vid=100 + cluster_index,
+                    site=site,
+                    defaults=dict(name="bench{0}".format(cluster_index)),
+                )
+                prefix, _ = Prefix.objects.get_or_create(
+                    prefix="10.{0}.{1}.0/20".format(200 + site_index, cluster_index * 16),
+                    site=site,
+                    defaults=dict(vlan=vlan, is_pool=True),
+                )
+                self.clusters.append((cluster, prefix, vlan))
+
+        for name in tag_names:
+            Tag.objects.get_or_create(name=name, defaults=dict(slug=slugify(name)))
+
+        context, created = ConfigContext.objects.get_or_create(name='benchmark', defaults=dict(data=self.CONFIG_CONTEXT))
+        if created:
+            context.tenants.add(self.tenant)
+        return self
+
+
+class SyntheticCSV:
+    """
+    Generates a BulkDeployVM CSV of a given size and shape from seeded fixtures
+    """
+
+    FIELDS = ['status', 'tenant', 'cluster', 'prom_alert_type', 'datazone', 'env', 'platform', 'role', 'backup', 'vcpus', 'memory', 'disk', 'hostname', 'ip_address', 'vlan', 'extra_tags']
+
+    def __init__(self, fixtures, rows=1000, extra_tags=2, vlan_share=25, seed=1):
+        self.fixtures = fixtures
+        self.rows = rows
+        self.extra_tags = extra_tags
+        # Percentage of rows without an address, these are allocated from the cluster VLAN's pool
+        self.vlan_share = vlan_share
+        self.random = random.Random(seed)
+
+    def iter_rows(self):
+        offsets = {}
+        for i in range(self.rows):
+            cluster, prefix, vlan = self.random.choice(self.fixtures.clusters)
+            role = self.random.choice(self.fixtures.roles)
+            env = self.random.choice(self.fixtures.get_envs(cluster.site.name))
+            vcpus = self.random.choice([1, 2, 4, 8])
+
+            # Explicit addresses are handed out in order from the upper half of the cluster prefix,
+            # the pool allocator hands out the lower half first
+            network = prefix.prefix
+            address = ""
+            if self.random.randrange(100) >= self.vlan_share:
+                offsets[prefix.pk] = offsets.get(prefix.pk, network.size // 2 - 1) + 1
+                address = "{0}/{1}".format(network[offsets[prefix.pk]], network.prefixlen)
+
+            yield dict(
+                status='planned',
+                tenant=self.fixtures.tenant.slug,
+                cluster=cluster.name,
+                prom_alert_type='24-7-devops',
+                datazone=self.random.choice(['1', '2']),
+                env=env,
+                platform=self.fixtures.platform.name,
+                role=role.name,
+                backup=self.random.choice(self.fixtures.BACKUP_TAGS),
+                vcpus=vcpus,
+                memory=vcpus * 2048,
+                disk=self.random.choice([10, 20, 50]),
+                hostname="{0}{1:05d}".format(VM.hostname_prefix(cluster.site, Tag(name="env_{0}".format(env)), role), i + 1),
+                ip_address=address,
+                vlan=vlan.vid if address == "" else "",
+                extra_tags=",".join("bench_tag_{0}".format(self.random.randrange(10)) for _ in range(self.extra_tags)),
+            )
+
+    def get_csv(self):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=self.FIELDS, lineterminator="\n")
+        writer.writeheader()
+        for row in self.iter_rows():
+            writer.writerow(row)
+        return output.getvalue()
+
+
+def run_benchmark(vms, mode='row', commit_every=None, commit=False):
+    """
+    Run BulkDeployVM on a CSV and report rows/sec, queries/row and peak memory
+
+    Without commit everything written is rolled back afterwards
+    """
+    script = BulkDeployVM()
+    data = dict(
+        vms=vms,
+        vms_file=None,
+        mode=mode,
+        commit_every=commit_every,
+        default_status=None,
+        default_tenant=None,
+        default_datazone='rr',
+        default_prom_alert_type=None,
+        default_cluster=None,
+        default_env=None,
+        default_platform=None,
+        default_role=None,
+        default_backup=None,
+        default_backup_offsite=None,
+    )
+    rows = max(len(vms.splitlines()) - 1, 1)
+    queries = [0]
+
+    def count_query(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with transaction.atomic():
+        with connection.execute_wrapper(count_query):
+            script.run(data, commit)
+        if not commit:
+            transaction.set_rollback(True)
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return dict(
+        rows=rows,
+        seconds=seconds,
+        rows_per_second=rows / seconds,
+        queries=queries[0],
+        queries_per_row=queries[0] / rows,
+        peak_memory_mb=peak_memory / 1024 / 1024,
+        failures=len([entry for entry in script.log if entry[0] == LogLevelChoices.LOG_FAILURE]),
+        phases=script.stats.get_queries(),
+    )
+
+
+class QueryBudget:
+    """
+    Query budgets for the import path, checked on batches of 1, 10 and 100 rows
+
+    A phase may use `fixed + per_row * rows` queries. Phases without a per row
+    budget are batched, their total must grow sublinearly with the row count.
+
+    This is not an automated test, nothing runs it in CI. It needs a NetBox database
+    and is run by hand as the QueryBudgetBulkDeployVM script inside NetBox.
+    """
+
+    SIZES = [1, 10, 100]
+
+    # phase: (fixed, per_row)
+    BUDGETS = {
+        'validate': (0, 0),
+        'preflight': (4, 0),
+        'placement': (3, 0),
+        'preload': (14, 0),
+        'set_cluster': (0, 0),
+        'set_prom_alert_type': (0, 0),
+        'set_status': (0, 0),
+        'set_tenant': (0, 0),
+        'set_datazone': (0, 0),
+        'set_env': (0, 0),
+        'set_platform': (0, 0),
+        'set_role': (0, 0),
+        'set_backup_tag': (0, 0),
+        'set_backup_offsite_tag': (2, 0),
+        'set_vcpus': (0, 0),
+        'set_memory': (0, 0),
+        'set_disk': (0, 0),
+        'set_hostname': (1, 0),
+        'set_vlan': (0, 0),
+        'set_extra_tags': (0, 0),
+        'set_comments': (0, 0),
+        'build': (1, 0),
+        'create_vm': (2, 0),
+        'create_ip_address': (4, 0),
+        'create_tags': (7, 0),
+        'config_context': (2, 0),
+        'create_interface': (4, 0),
+        'create_service': (4, 0),
+        'changelog': (10, 0),
+    }
+
+    # Row mode saves every object on its own, the write phases get an explicit allowance per row
+    ROW_BUDGETS = dict(
+        BUDGETS,
+        create_vm=(0, 2),
+        create_ip_address=(0, 3),
+        create_tags=(7, 4),
+        create_interface=(2, 3),
+        create_service=(0, 6),
+    )
+
+    def __init__(self, fixtures, mode='bulk', seed=1):
+        self.fixtures = fixtures
+        self.mode = mode
+        self.seed = seed
+
+    def get_budgets(self):
+        return self.ROW_BUDGETS if self.mode == 'row' else self.BUDGETS
+
+    def get_budget(self, phase):
+        fixed, per_row = self.get_budgets()[phase]
+        # Row mode renders the config context while creating the interface
+        if phase == ('create_interface' if self.mode == 'row' else 'config_context'):
+            # One render per profile, the fixtures bound the profiles whatever the row count
+            fixed += len(self.fixtures.clusters) * len(self.fixtures.roles)
+        return fixed, per_row
+
+    def get_totals(self, rows):
+        vms = SyntheticCSV(self.fixtures, rows=rows, seed=self.seed).get_csv()
+        result = run_benchmark(vms, mode=self.mode)
+        if result['failures'] > 0:
+            raise Exception("{0} of {1} rows failed".format(result['failures'], rows))
+        return result['phases']
+
+    def check(self):
+        """
+        Returns a list of budget violations, empty if every phase is within budget
+        """
+        totals = {rows: self.get_totals(rows) for rows in self.SIZES}
+
+        violations = []
+        for rows, phases in totals.items():
+            for phase, queries in phases.items():
+                if phase not in self.get_budgets():
+                    violations.append("Phase `{0}` has no query budget".format(phase))
+                    continue
+                fixed, per_row = self.get_budget(phase)
+                if queries > fixed + per_row * rows:
+                    violations.append("Phase `{0}` used {1:g} queries for {2} rows, budget is {3} + {4} per row".format(phase, queries, rows, fixed, per_row))
+
+        # Batched phases may grow at most with the square root of the row count
+        smallest, largest = self.SIZES[1], self.SIZES[-1]
+        for phase, (fixed, per_row) in self.get_budgets().items():
+            if per_row > 0:
+                continue
+            small = totals[smallest].get(phase, 0)
+            large = totals[largest].get(phase, 0)
+            if large > max(small, 1) * (largest / smallest) ** 0.5:
+                violations.append("Phase `{0}` grew from {1:g} to {2:g} queries between {3} and {4} rows".format(phase, small, large, smallest, largest))
+
+        return sorted(set(violations))
+
+
+class BenchmarkBulkDeployVM(Script):
+    """
+    Seeds benchmark fixtures, generates a synthetic CSV and times BulkDeployVM on it
+
+    Runs against the local database only, run it without commit to leave no trace
+    """
+
+    class Meta:
+        name = "Benchmark bulk deploy"
+        description = "Time BulkDeployVM on a synthetic CSV"
+        field_order = ['rows', 'mode', 'sites', 'clusters', 'roles', 'extra_tags', 'vlan_share', 'seed', 'show_csv']
+        commit_default = False
+
+    rows = IntegerVar(
+        label="Rows",
+        description="Number of VMs in the synthetic CSV",
+        default=1000,
+        min_value=1,
+    )
+
+    mode = ChoiceVar(
+        label="Mode",
+        description="BulkDeployVM mode to benchmark",
+        default="row",
+        choices=(
+            ('row', 'Row by row'),
+            ('bulk', 'Bulk'),
+            ('plan', 'Plan only'),
+        )
+    )
+
+    sites = IntegerVar(
+        label="Sites",
+        default=2,
+        min_value=1,
+        max_value=len(BenchmarkFixtures.SITES),
+    )
+
+    clusters = IntegerVar(
+        label="Clusters per site",
+        default=2,
+        min_value=1,
+        max_value=16,
+    )
+
+    roles = IntegerVar(
+        label="Roles",
+        default=3,
+        min_value=1,
+    )
+
+    extra_tags = IntegerVar(
+        label="Extra tags per row",
+        default=2,
+        min_value=0,
+    )
+
+    vlan_share = IntegerVar(
+        label="VLAN rows (%)",
+        description="Share of rows without an IP address, allocated from the VLAN pool instead",
+        default=25,
+        min_value=0,
+        max_value=100,
+    )
+
+    seed = IntegerVar(
+        label="Random seed",
+        default=1,
+    )
+
+    show_csv = BooleanVar(
+        label="Show CSV",
+        description="Return the generated CSV instead of the results",
+        default=False,
+    )
+
+    def run(self, data, commit):
+        fixtures = BenchmarkFixtures(sites=data['sites'], clusters=data['clusters'], roles=data['roles']).seed()
+        vms = SyntheticCSV(fixtures, rows=data['rows'], extra_tags=data['extra_tags'], vlan_share=data['vlan_share'], seed=data['seed']).get_csv()
+        if data['show_csv']:
+            return vms
+
+        # The benchmark rolls back what it imported, the fixtures stay if committed
+        result = run_benchmark(vms, mode=data['mode'])
+        self.log_info("{rows} rows in {seconds:.2f} s, {rows_per_second:.1f} rows/sec, {queries_per_row:.2f} queries/row, peak memory {peak_memory_mb:.1f} MB".format(**result))
+        if result['failures'] > 0:
+            self.log_warning("{0} rows failed, see a run of the import script for details".format(result['failures']))
+        return "\n".join("{0}: {1}".format(key, value) for key, value in result.items())
+
+
+class QueryBudgetBulkDeployVM(Script):
+    """
+    Fails if a phase of the import path goes over its query budget
+
+    Run it by hand without commit after changing bulk_vm.py to catch N+1 regressions, it is
+    not an automated test. Row mode is checked against its own per row budgets.
+    """
+
+    class Meta:
+        name = "Query budget bulk deploy"
+        description = "Check the queries per phase of BulkDeployVM against their budget"
+        field_order = ['mode', 'seed']
+        commit_default = False
+
+    mode = ChoiceVar(
+        label="Mode",
+        description="BulkDeployVM mode to check",
+        default="bulk",
+        choices=(
+            ('row', 'Row by row'),
+            ('bulk', 'Bulk'),
+            ('plan', 'Plan only'),
+        )
+    )
+
+    seed = IntegerVar(
+        label="Random seed",
+        default=1,
+    )
+
+    def run(self, data, commit):
+        fixtures = BenchmarkFixtures().seed()
+        violations = QueryBudget(fixtures, mode=data['mode'], seed=data['seed']).check()
+        for violation in violations:
+            self.log_failure(violation)
+        if len(violations) == 0:
+            self.log_success("All phases within their query budget for {0} rows".format(", ".join(str(rows) for rows in QueryBudget.SIZES)))
+        return "\n".join(violations)